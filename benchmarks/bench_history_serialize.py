@@ -0,0 +1,82 @@
+# Micro-benchmark for the /api/history serializer.
+# Compares the original iterrows + per-cell helper + jsonify path with the columnar
+# serializer (records and columns shapes) on a synthetic three-year daily series.
+#
+#   python benchmarks/bench_history_serialize.py [--bars 730] [--repeat 200]
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+from flask import jsonify
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import stock_dashboard as sd
+
+
+def make_hist_frame(n):
+    rng = np.random.default_rng(0)
+    dates = pd.bdate_range(end='2026-10-16', periods=n)
+    close = 100 + rng.standard_normal(n).cumsum()
+    df = pd.DataFrame({
+        '日期': [d.date() for d in dates],
+        '开盘': close + rng.standard_normal(n) * 0.5,
+        '收盘': close,
+        '最高': close + 1,
+        '最低': close - 1,
+        '成交量': rng.integers(10_000, 1_000_000, n),
+    })
+    df.loc[n // 2, '开盘'] = np.nan # exercise the NaN -> null path
+    return df
+
+
+# The row-dict serializer /api/history used before the columnar one
+def to_float_or_none(val):
+    try: return float(val) if pd.notna(val) else None
+    except ValueError: return None
+
+def to_int_or_none(val):
+    try: return int(val) if pd.notna(val) else None
+    except ValueError: return None
+
+def legacy_serialize(stock_hist_df):
+    history_data = []
+    for index, row in stock_hist_df.iterrows():
+        history_data.append({
+            "date": row['日期'],
+            "open": to_float_or_none(row['开盘']),
+            "close": to_float_or_none(row['收盘']),
+            "low": to_float_or_none(row['最低']),
+            "high": to_float_or_none(row['最高']),
+            "volume": to_int_or_none(row['成交量']),
+        })
+    return jsonify(history_data).get_data()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the /api/history serializer')
+    parser.add_argument('--bars', type=int, default=730)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    df = make_hist_frame(args.bars)
+    bars = sd.hist_frame_to_bars(df)
+    cases = [
+        ("legacy iterrows + jsonify", lambda: legacy_serialize(df)),
+        ("columnar records", lambda: sd.json_response(sd.bars_to_records(bars)).get_data()),
+        ("columnar columns", lambda: sd.json_response(sd.bars_to_columns(bars)).get_data()),
+    ]
+    print(f"{args.bars} bars, {args.repeat} runs each, encoder: {'orjson' if sd.orjson else 'json'}")
+    with sd.app.app_context():
+        baseline = None
+        for name, fn in cases:
+            size = len(fn())
+            seconds = min(timeit.repeat(fn, number=args.repeat, repeat=3)) / args.repeat
+            baseline = baseline or seconds
+            print(f"{name:28s} {seconds * 1e3:8.3f} ms  {size / 1024:7.1f} KiB  x{baseline / seconds:5.1f}")
+
+
+if __name__ == '__main__':
+    main()
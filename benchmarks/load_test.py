@@ -0,0 +1,264 @@
+# Load test for the dashboard's HTTP API.
+# Drives a running server (--url) or starts one per serving mode (--compare threaded asgi)
+# with N concurrent keep-alive clients per step, optionally holding extra idle connections
+# open like parked dashboard tabs, and reports throughput and latency percentiles.
+#
+# --scenarios runs the search / realtime / batch / history suites one after another, with
+# requests spread over the stocks the server actually knows (read from /api/screener).
+# Servers started by --compare can use an offline upstream (--backend replay with fixtures
+# from record_fixtures.py, or the built-in fake) and a fresh data directory, so runs are
+# reproducible on a machine without network.
+#
+#   python benchmarks/load_test.py --url http://127.0.0.1:5001 --concurrency 10 100 500
+#   python benchmarks/load_test.py --compare threaded asgi --idle-connections 2000
+#   python benchmarks/load_test.py --compare asgi --backend replay --latency 0.2 \
+#       --scenarios search realtime batch history --concurrency 1 10 50 200 --json results.json
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import quote, urlsplit
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+DEFAULT_PATHS = ['/api/realtime?code=600519', '/api/search?query=gzmt&limit=8']
+SCENARIOS = ('search', 'realtime', 'batch', 'history')
+
+
+class HTTPConnection:
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+        self.reader = self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def get(self, path):
+        if self.writer is None:
+            await self.connect()
+        self.writer.write(f"GET {path} HTTP/1.1\r\nHost: {self.host}\r\nConnection: keep-alive\r\n\r\n".encode())
+        await self.writer.drain()
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("connection closed by server")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        body = b''
+        if headers.get('transfer-encoding') == 'chunked':
+            while True:
+                size = int((await self.reader.readline()).strip(), 16)
+                body += (await self.reader.readexactly(size + 2))[:-2]
+                if size == 0:
+                    break
+        else:
+            body = await self.reader.readexactly(int(headers.get('content-length', 0)))
+        if headers.get('connection', '').lower() == 'close':
+            await self.close()
+        return status, body
+
+
+async def client(host, port, paths, deadline, latencies, errors, offset):
+    conn = HTTPConnection(host, port)
+    i = offset
+    while time.perf_counter() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        started = time.perf_counter()
+        try:
+            status, _ = await conn.get(path)
+            if status >= 500:
+                errors.append(status)
+            latencies.append(time.perf_counter() - started)
+        except Exception as e:
+            errors.append(type(e).__name__)
+            await conn.close()
+    await conn.close()
+
+
+async def run_step(host, port, paths, concurrency, duration, idle_connections):
+    idle = []
+    for _ in range(idle_connections):
+        conn = HTTPConnection(host, port)
+        try:
+            await conn.connect()
+            idle.append(conn)
+        except OSError:
+            break
+    latencies, errors = [], []
+    started = time.perf_counter()
+    deadline = started + duration
+    await asyncio.gather(*(client(host, port, paths, deadline, latencies, errors, n) for n in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    for conn in idle:
+        await conn.close()
+    return {
+        'concurrency': concurrency,
+        'idle': len(idle),
+        'requests': len(latencies),
+        'rps': len(latencies) / elapsed,
+        'p50': np.percentile(latencies, 50) * 1e3 if latencies else float('nan'),
+        'p99': np.percentile(latencies, 99) * 1e3 if latencies else float('nan'),
+        'errors': len(errors),
+    }
+
+
+def wait_until_up(host, port, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            asyncio.run(HTTPConnection(host, port).get('/api/search?query=600519'))
+            return
+        except OSError:
+            time.sleep(0.5)
+    raise RuntimeError(f"server on port {port} did not come up within {timeout}s")
+
+
+async def fetch_json(host, port, path):
+    conn = HTTPConnection(host, port)
+    try:
+        status, body = await conn.get(path)
+    finally:
+        await conn.close()
+    return status, json.loads(body or b'null')
+
+
+def discover_universe(host, port, timeout=60):
+    # The most traded stocks in the server's current snapshot; waits for the first snapshot
+    deadline = time.time() + timeout
+    while True:
+        status, data = asyncio.run(fetch_json(host, port, '/api/screener?sort=turnover&limit=500&fields=code,name'))
+        if status == 200 and data['quotes']:
+            return [(quote['code'], quote['name']) for quote in data['quotes']]
+        if time.time() > deadline:
+            raise RuntimeError(f"no spot snapshot from the server: {status} {data}")
+        time.sleep(1)
+
+
+def scenario_paths(scenario, universe):
+    codes = [code for code, _ in universe]
+    if scenario == 'search':
+        queries = [code[:4] for code in codes[:50]] + [name[:2] for _, name in universe[:50]] + codes[:50]
+        return [f"/api/search?query={quote(query)}&limit=8" for query in queries]
+    if scenario == 'realtime':
+        return [f"/api/realtime?code={code}" for code in codes[:200]]
+    if scenario == 'batch':
+        return [f"/api/realtime/batch?codes={','.join(codes[i:i + 50])}" for i in range(0, min(len(codes), 200), 50)]
+    if scenario == 'history':
+        return [f"/api/history?code={code}&format=columns" for code in codes[:20]]
+    raise ValueError(scenario)
+
+
+async def warm_up(host, port, paths):
+    # One pass over every path first, so steps measure the steady state (stored K-lines,
+    # built indexes), not the first upstream download. Returns the paths that answered 2xx,
+    # e.g. only the stocks whose K-lines are in the replay fixtures.
+    conn = HTTPConnection(host, port)
+    ok = []
+    try:
+        for path in paths:
+            status, _ = await conn.get(path)
+            if status < 300:
+                ok.append(path)
+    finally:
+        await conn.close()
+    return ok
+
+
+def start_server(mode, port, env=None):
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, 'stock_dashboard.py'), '--server', mode,
+                             '--host', '127.0.0.1', '--port', str(port)],
+                            env={**os.environ, **(env or {})}, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def server_env(args, data_dir):
+    env = {'STOCKAI_DATA_DIR': data_dir}
+    if args.backend:
+        env['STOCKAI_UPSTREAM_BACKEND'] = args.backend
+    if args.fixtures:
+        env['STOCKAI_FIXTURE_DIR'] = os.path.abspath(args.fixtures)
+    if args.latency is not None:
+        env['STOCKAI_REPLAY_LATENCY' if args.backend == 'replay' else 'STOCKAI_FAKE_LATENCY'] = str(args.latency)
+    return env
+
+
+def report(label, results):
+    print(f"\n== {label}")
+    print(f"{'scenario':>9} {'conc':>6} {'idle':>6} {'requests':>9} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for r in results:
+        print(f"{r['scenario']:>9} {r['concurrency']:6d} {r['idle']:6d} {r['requests']:9d} {r['rps']:9.1f} "
+              f"{r['p50']:8.2f} {r['p99']:8.2f} {r['errors']:7d}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the stock dashboard API')
+    parser.add_argument('--url', default='http://127.0.0.1:5001', help='server to test when --compare is not given')
+    parser.add_argument('--compare', nargs='+', choices=('threaded', 'asgi'),
+                        help='start stock_dashboard.py in each serving mode and test them in turn')
+    parser.add_argument('--port', type=int, default=5101, help='port used for servers started by --compare')
+    parser.add_argument('--paths', nargs='+', default=DEFAULT_PATHS)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, help='run these suites instead of --paths')
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[10, 50, 200])
+    parser.add_argument('--duration', type=float, default=10, help='seconds per concurrency step')
+    parser.add_argument('--idle-connections', type=int, default=0,
+                        help='extra idle keep-alive connections held open during each step')
+    parser.add_argument('--backend', choices=('akshare', 'fake', 'replay'),
+                        help='upstream used by servers started by --compare')
+    parser.add_argument('--fixtures', help='fixture directory for --backend replay')
+    parser.add_argument('--latency', type=float, help='simulated upstream latency in seconds (fake/replay)')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    def run_all(host, port):
+        if args.scenarios:
+            universe = discover_universe(host, port)
+            suites = [(scenario, scenario_paths(scenario, universe)) for scenario in args.scenarios]
+        else:
+            suites = [('paths', args.paths)]
+        results = []
+        for scenario, paths in suites:
+            paths = asyncio.run(warm_up(host, port, paths)) or paths
+            for c in args.concurrency:
+                result = asyncio.run(run_step(host, port, paths, c, args.duration, args.idle_connections))
+                results.append({'scenario': scenario, **result})
+        return results
+
+    runs = {}
+    if not args.compare:
+        url = urlsplit(args.url)
+        runs[args.url] = run_all(url.hostname, url.port or 80)
+        report(args.url, runs[args.url])
+    for mode in args.compare or ():
+        data_dir = tempfile.mkdtemp(prefix='stockai-bench-')
+        server = start_server(mode, args.port, server_env(args, data_dir))
+        try:
+            wait_until_up('127.0.0.1', args.port)
+            runs[mode] = run_all('127.0.0.1', args.port)
+            report(f"{mode} server", runs[mode])
+        finally:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(data_dir, ignore_errors=True)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(runs, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
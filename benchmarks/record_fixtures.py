@@ -0,0 +1,78 @@
+# Record upstream responses for offline replay (STOCKAI_UPSTREAM_BACKEND=replay).
+# Calls go through the dashboard's upstream client, so the usual rate limit and retries apply.
+#
+#   python benchmarks/record_fixtures.py --spot 3 --top 100 --keywords 茅台 平安
+#   STOCKAI_UPSTREAM_BACKEND=replay python benchmarks/load_test.py --compare asgi
+#
+# --source fake records the built-in fake backend instead of akshare (no network needed).
+import argparse
+import os
+import sys
+import time
+from datetime import timedelta
+
+import pandas as pd
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record akshare responses as replay fixtures')
+    parser.add_argument('--fixtures', help='fixture directory (default: STOCKAI_FIXTURE_DIR or data/fixtures)')
+    parser.add_argument('--source', choices=('akshare', 'fake'), default='akshare')
+    parser.add_argument('--spot', type=int, default=3, help='number of spot snapshots to record')
+    parser.add_argument('--interval', type=float, default=3, help='seconds between spot snapshots')
+    parser.add_argument('--symbols', nargs='*', default=[], help='codes whose daily K-lines are recorded')
+    parser.add_argument('--top', type=int, default=50, help='also record K-lines of the N most traded stocks')
+    parser.add_argument('--adjust', nargs='+', default=['none', 'hfq'],
+                        help='adjustments to record (qfq, hfq, none); the K-line store fetches none + hfq')
+    parser.add_argument('--keywords', nargs='*', default=[], help='stock_fuzzy_search keywords to record')
+    args = parser.parse_args()
+
+    if args.fixtures:
+        os.environ['STOCKAI_FIXTURE_DIR'] = args.fixtures
+    os.environ['STOCKAI_UPSTREAM_BACKEND'] = 'record'
+    sys.path.insert(0, ROOT)
+    import stock_dashboard as sd
+    if args.source == 'fake':
+        sd.upstream.backend.inner = sd.FakeUpstreamBackend()
+    print(f"Recording {args.source} responses into {sd.FIXTURE_DIR}")
+
+    spot = None
+    for i in range(args.spot):
+        if i:
+            time.sleep(args.interval)
+        spot = sd.upstream.call('stock_zh_a_spot_em')
+        print(f"spot snapshot {i + 1}/{args.spot}: {len(spot)} rows")
+
+    calendar = sd.upstream.call('tool_trade_date_hist_sina')
+    print(f"trade calendar: {len(calendar)} days")
+
+    symbols = list(args.symbols)
+    if args.top and spot is not None:
+        turnover = pd.to_numeric(spot['成交额'], errors='coerce')
+        symbols += [code for code in spot.loc[turnover.sort_values(ascending=False).index, '代码'].astype(str)[:args.top]
+                    if code not in symbols]
+    end = sd.market_now().date()
+    start = end - timedelta(days=sd.HISTORY_DAYS)
+    started = time.perf_counter()
+    for n, code in enumerate(symbols, 1):
+        for adjust in args.adjust:
+            adjust = '' if adjust == 'none' else adjust
+            try:
+                df = sd.upstream.call('stock_zh_a_hist', symbol=code, period="daily", start_date=start.strftime('%Y%m%d'),
+                                      end_date=end.strftime('%Y%m%d'), adjust=adjust)
+                rows = 0 if df is None else len(df)
+            except Exception as e:
+                rows = f"failed: {e}"
+            print(f"[{n}/{len(symbols)}] {code} {adjust or 'none'}: {rows}")
+    if symbols:
+        print(f"K-lines: {len(symbols) * len(args.adjust) / (time.perf_counter() - started):.1f} calls/s")
+
+    for keyword in args.keywords:
+        df = sd.upstream.call('stock_fuzzy_search', keyword=keyword)
+        print(f"fuzzy search '{keyword}': {len(df)} rows")
+
+
+if __name__ == '__main__':
+    main()
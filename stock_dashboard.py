@@ -1,8 +1,34 @@
 from flask import Flask, render_template_string, request, jsonify
+from werkzeug.exceptions import BadRequest
+from werkzeug.http import http_date
 import akshare as ak
 import pandas as pd
+import numpy as np
+import argparse
+import asyncio
+import difflib
+import gzip
+import hashlib
+import io
 import json
-from datetime import datetime
+import multiprocessing
+import os
+import queue
+import random
+import re
+import signal
+import struct
+import sys
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, as_completed
+from contextlib import contextmanager
+from datetime import datetime, timedelta, time as dtime
+from multiprocessing import resource_tracker, shared_memory
+from urllib.parse import parse_qs
+from zoneinfo import ZoneInfo
 
 app = Flask(__name__)
 
@@ -36,7 +62,8 @@ HTML_TEMPLATE = """
 
         <div class="section">
             <h2>股票检索</h2>
-            <input type="text" id="stockQuery" placeholder="输入6位股票代码 (例如: 600519) 或 名称 (例如: 贵州茅台)">
+            <input type="text" id="stockQuery" list="stockSuggestions" autocomplete="off" placeholder="输入6位股票代码 (例如: 600519)、名称 (例如: 贵州茅台) 或拼音首字母 (例如: gzmt)">
+            <datalist id="stockSuggestions"></datalist>
             <button onclick="searchStock()">检索</button>
             <div id="searchError" class="error"></div>
             <div id="stockInfo" class="info-grid" style="margin-top:15px;"></div>
@@ -64,7 +91,7 @@ HTML_TEMPLATE = """
         </div>
 
         <div class="section">
-            <h2>日K线图</h2>
+            <h2>K线图</h2>
             <div id="klineError" class="error"></div>
             <div id="klineChartContainer" style="width: 100%; height: 450px;">
                  <div id="klineChart" style="width: 100%; height: 100%;"></div>
@@ -93,6 +120,7 @@ HTML_TEMPLATE = """
                 return;
             }
             klineChartInstance = echarts.init(chartDom);
+            klineChartInstance.on('datazoom', onKlineZoom);
             klineChartInstance.setOption({
                 title: { text: '请先检索股票以加载K线数据', left: 'center', top: 'center', textStyle: {color: '#888'} },
                 xAxis: {show:false}, yAxis: {show:false}
@@ -144,6 +172,7 @@ HTML_TEMPLATE = """
                 document.getElementById('currentStockCodeDisplay').innerText = data.code;
 
                 fetchRealtimeData(currentStockCode); // 首次加载实时数据
+                subscribeQuotes(currentStockCode); // 之后由服务端推送更新
                 fetchAndDrawKLine(currentStockCode);
                 document.getElementById('manualRefreshBtn').disabled = false; // 启用刷新按钮
 
@@ -184,153 +213,2948 @@ HTML_TEMPLATE = """
                     return;
                 }
                 
-                const fields = {
-                    'stockPrice': data.price,
-                    'stockChangeAmount': data.change_amount,
-                    'stockChangePercent': data.change_percent,
-                    'stockVolume': data.volume !== null ? (data.volume / 100).toLocaleString() : '--', 
-                    'stockTurnover': data.turnover !== null ? (data.turnover / 10000).toLocaleString(undefined, {minimumFractionDigits: 2, maximumFractionDigits: 2}) + ' 万' : '--', 
-                    'stockOpen': data.open,
-                    'stockPrevClose': data.prev_close,
-                    'stockHigh': data.high,
-                    'stockLow': data.low
+                renderQuote(data);
+
+            } catch (error) {
+                console.error('Realtime data error:', error);
+                displayError('realtimeError', '获取实时数据失败: ' + error.message);
+            } finally {
+                refreshBtn.disabled = false; // 无论成功失败都恢复按钮
+                refreshBtn.innerText = '手动刷新';
+            }
+        }
+
+        // 字段 -> [元素ID, 格式化函数]；推送的增量只包含变化的字段，未出现的字段保持不变
+        const QUOTE_DISPLAY = {
+            price: ['stockPrice', v => v],
+            change_amount: ['stockChangeAmount', v => v],
+            change_percent: ['stockChangePercent', v => v],
+            volume: ['stockVolume', v => (v / 100).toLocaleString()],
+            turnover: ['stockTurnover', v => (v / 10000).toLocaleString(undefined, {minimumFractionDigits: 2, maximumFractionDigits: 2}) + ' 万'],
+            open: ['stockOpen', v => v],
+            prev_close: ['stockPrevClose', v => v],
+            high: ['stockHigh', v => v],
+            low: ['stockLow', v => v]
+        };
+
+        function renderQuote(data) {
+            for (const field in QUOTE_DISPLAY) {
+                if (!(field in data)) continue;
+                const [id, format] = QUOTE_DISPLAY[field];
+                const el = document.getElementById(id);
+                if (el) el.innerText = data[field] !== null && data[field] !== undefined ? format(data[field]) : '--';
+            }
+            const luEl = document.getElementById('lastUpdated');
+            if (luEl) luEl.innerText = new Date().toLocaleTimeString();
+        }
+
+        // 订阅服务端推送 (SSE)：行情变化时自动更新，无需轮询
+        let quoteStream = null;
+        function subscribeQuotes(stockCode) {
+            if (quoteStream) quoteStream.close();
+            quoteStream = null;
+            if (!stockCode || !window.EventSource) return;
+            quoteStream = new EventSource(`/api/stream?codes=${stockCode}`);
+            const onQuotes = event => {
+                const data = JSON.parse(event.data);
+                const quote = data.quotes && data.quotes[stockCode];
+                if (quote && stockCode === currentStockCode) renderQuote(quote);
+            };
+            quoteStream.addEventListener('snapshot', onQuotes);
+            quoteStream.addEventListener('delta', onQuotes);
+        }
+
+        // 新增手动刷新函数
+        function manualRefreshData() {
+            if (currentStockCode) {
+                fetchRealtimeData(currentStockCode);
+            } else {
+                displayError('realtimeError', '请先检索一只股票。');
+            }
+        }
+
+        // K线按需加载：先按图表宽度取整个区间的概览（区间长时服务端自动合并为周K、月K），
+        // 缩放或拖动后只取可见区间，K线随可见范围变细；可见区间外仍显示概览
+        const KLINE_BAR_PIXELS = 4; // 每根K线大约占用的像素
+        const KLINE_PERIOD_NAMES = { daily: '日K', weekly: '周K', monthly: '月K' };
+        const KLINE_FIELDS = ['date', 'open', 'close', 'high', 'low', 'volume'];
+        let klineOverview = null;
+        let klineRequest = 0; // 只采用最近一次请求的结果
+        let klineZoomTimer = null;
+
+        function klinePoints() {
+            return Math.max(20, Math.min(5000, Math.round(klineChartInstance.getWidth() * 0.82 / KLINE_BAR_PIXELS)));
+        }
+
+        function periodLabel(period) {
+            // X-Kline-Period 如 daily、weekly、monthlyx3（连续 3 根月K合并为一根）
+            const [base, count] = period.split('x');
+            const name = KLINE_PERIOD_NAMES[base] || base;
+            return count ? `${name}（每 ${count} 根合并）` : name;
+        }
+
+        function parseDate(text) {
+            const [year, month, day] = text.split('-').map(Number);
+            return new Date(year, month - 1, day).getTime(); // 与 ECharts 一样按本地时间解析
+        }
+
+        function formatDate(ms) {
+            const d = new Date(ms);
+            return `${d.getFullYear()}-${String(d.getMonth() + 1).padStart(2, '0')}-${String(d.getDate()).padStart(2, '0')}`;
+        }
+
+        async function fetchHistory(stockCode, params) {
+            const query = new URLSearchParams({ code: stockCode, format: 'columns', points: klinePoints(), ...params }); // 按列返回，省去逐行对象
+            const response = await fetch(`/api/history?${query}`);
+            if (!response.ok) {
+                const errData = await response.json().catch(() => ({error: "获取历史数据失败。"}));
+                throw new Error(errData.error || `服务器错误: ${response.status}`);
+            }
+            const data = await response.json();
+            if (data.error) throw new Error(data.error);
+            data.period = response.headers.get('X-Kline-Period') || 'daily';
+            return data;
+        }
+
+        function drawKLine(data, period, zoom) {
+            const candles = data.date.map((date, idx) => [date, data.open[idx], data.close[idx], data.low[idx], data.high[idx]]);
+            const volumes = data.date.map((date, idx) => ({
+                value: [date, data.volume[idx]],
+                itemStyle: { color: data.open[idx] > data.close[idx] ? '#0CF49B' : '#FD1050' } // 阳红柱，阴绿柱
+            }));
+            const option = {
+                title: { text: `K线周期：${periodLabel(period)}`, left: 'left', textStyle: { fontSize: 14 } },
+                series: [{ data: candles }, { data: volumes }]
+            };
+            if (zoom) option.dataZoom = [zoom, zoom];
+            klineChartInstance.setOption(option);
+        }
+
+        function mergeDetail(detail) {
+            // 可见区间用细粒度数据，两侧保留概览（合并后的K线以区间最后一天为日期）
+            const first = detail.date[0], last = detail.date[detail.date.length - 1];
+            const merged = {};
+            KLINE_FIELDS.forEach(field => merged[field] = []);
+            const append = (source, keep) => source.date.forEach((date, idx) => {
+                if (keep(date)) KLINE_FIELDS.forEach(field => merged[field].push(source[field][idx]));
+            });
+            append(klineOverview, date => date < first);
+            append(detail, () => true);
+            append(klineOverview, date => date > last);
+            return merged;
+        }
+
+        async function fetchVisibleKLine() {
+            const stockCode = currentStockCode;
+            if (!klineOverview || !stockCode || klineOverview.period === 'daily') return; // 概览已是日K，无需细化
+            // 细化的数据落在概览的首尾日期之间，时间轴范围不变，缩放百分比可以原样保留
+            const zoom = klineChartInstance.getOption().dataZoom[0];
+            const zoomRange = { start: zoom.start, end: zoom.end };
+            const first = parseDate(klineOverview.date[0]), last = parseDate(klineOverview.date[klineOverview.date.length - 1]);
+            const request = ++klineRequest;
+            if (zoom.start <= 0 && zoom.end >= 100) {
+                drawKLine(klineOverview, klineOverview.period, zoomRange);
+                return;
+            }
+            const start = formatDate(first + (last - first) * zoom.start / 100);
+            const end = formatDate(first + (last - first) * zoom.end / 100);
+            try {
+                const detail = await fetchHistory(stockCode, { start, end });
+                if (request !== klineRequest || stockCode !== currentStockCode) return;
+                drawKLine(mergeDetail(detail), detail.period, zoomRange);
+            } catch (error) {
+                console.error('K-line range error:', error);
+                displayError('klineError', '获取K线数据失败: ' + error.message);
+            }
+        }
+
+        function onKlineZoom() {
+            clearTimeout(klineZoomTimer);
+            klineZoomTimer = setTimeout(fetchVisibleKLine, 300); // 拖动停止后再请求
+        }
+
+        async function fetchAndDrawKLine(stockCode) {
+            if (!stockCode || !klineChartInstance) return;
+            clearError('klineError');
+            klineChartInstance.showLoading();
+            const request = ++klineRequest;
+            klineOverview = null;
+            try {
+                const data = await fetchHistory(stockCode, {});
+                if (request !== klineRequest) return;
+                klineOverview = data;
+
+                const option = {
+                    tooltip: {
+                        trigger: 'axis',
+                        axisPointer: { type: 'cross' }
+                    },
+                    legend: { data: ['K线', '成交量'] },
+                    grid: [
+                        { left: '10%', right: '8%', height: '50%' },
+                        { left: '10%', right: '8%', top: '65%', height: '16%' }
+                    ],
+                    xAxis: [
+                        { type: 'time', scale: true, axisLine: { onZero: false }, splitLine: { show: false } },
+                        { type: 'time', gridIndex: 1, scale: true, axisLine: { onZero: false }, axisTick: { show: false }, splitLine: { show: false }, axisLabel: { show: false } }
+                    ],
+                    yAxis: [
+                        { scale: true, splitArea: { show: true }, axisLabel: { formatter: function (value) { return value.toFixed(2); } } },
+                        { scale: true, gridIndex: 1, splitNumber: 2, axisLabel: { show: false }, axisLine: { show: false }, axisTick: { show: false }, splitLine: { show: false } }
+                    ],
+                    dataZoom: [ // 时间轴按日期缩放，替换为更细的K线后可见区间不变
+                        { type: 'inside', xAxisIndex: [0, 1], start: 0, end: 100 },
+                        { show: true, xAxisIndex: [0, 1], type: 'slider', top: '85%', start: 0, end: 100 }
+                    ],
+                    series: [
+                        {
+                            name: 'K线',
+                            type: 'candlestick',
+                            encode: { x: 0, y: [1, 2, 3, 4] },
+                            itemStyle: {
+                                color: '#FD1050', // 阳线 red
+                                color0: '#0CF49B', // 阴线 green
+                                borderColor: '#FD1050',
+                                borderColor0: '#0CF49B'
+                            }
+                        },
+                        {
+                            name: '成交量',
+                            type: 'bar',
+                            xAxisIndex: 1,
+                            yAxisIndex: 1
+                        }
+                    ]
                 };
+                klineChartInstance.hideLoading();
+                klineChartInstance.setOption(option, true);
+                drawKLine(data, data.period);
+            } catch (error) {
+                console.error('K-line data error:', error);
+                displayError('klineError', '获取K线数据失败: ' + error.message);
+                if (klineChartInstance) klineChartInstance.hideLoading();
+            }
+        }
+        
+        // 输入联想：停止输入 200ms 后请求候选列表
+        let suggestTimer = null;
+        function suggestStocks() {
+            clearTimeout(suggestTimer);
+            suggestTimer = setTimeout(async () => {
+                const query = document.getElementById('stockQuery').value.trim();
+                const list = document.getElementById('stockSuggestions');
+                if (!query) { list.innerHTML = ''; return; }
+                try {
+                    const response = await fetch(`/api/search?query=${encodeURIComponent(query)}&limit=8`);
+                    if (!response.ok) { list.innerHTML = ''; return; }
+                    const data = await response.json();
+                    list.innerHTML = '';
+                    (data.candidates || []).forEach(item => {
+                        const option = document.createElement('option');
+                        option.value = item.code;
+                        option.label = item.name;
+                        list.appendChild(option);
+                    });
+                } catch (error) {
+                    console.error('Suggest error:', error);
+                }
+            }, 200);
+        }
+
+        window.onload = () => {
+            initKlineChart();
+            document.getElementById('stockQuery').addEventListener('input', suggestStocks);
+            document.getElementById('manualRefreshBtn').disabled = true; // 初始禁用刷新按钮
+        }
+    </script>
+</body>
+</html>
+"""
+
+# --- Metrics ---
+# A small in-process registry rendered in the Prometheus text format at /metrics. Counters and
+# histograms are updated where things happen; values that already live elsewhere (cache stats,
+# snapshot age) are read by callbacks at scrape time. Each process keeps its own numbers.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+METRICS = []
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self._values = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [(self.name, labels, (), value) for labels, value in values.items()]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help, labels
+        self.buckets = np.asarray(buckets, dtype='float64')
+        self._values = {} # labels -> [bucket counts..., sum]
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, *label_values, value):
+        slot = int(np.searchsorted(self.buckets, value)) # first bucket with le >= value
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            counts[slot] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = {labels: list(counts) for labels, counts in self._values.items()}
+        samples = []
+        for labels, counts in values.items():
+            cumulative = np.cumsum(counts[:-1])
+            for le, count in zip([f"{b:g}" for b in self.buckets] + ['+Inf'], cumulative):
+                samples.append((f"{self.name}_bucket", labels, (('le', le),), int(count)))
+            samples.append((f"{self.name}_sum", labels, (), counts[-1]))
+            samples.append((f"{self.name}_count", labels, (), int(cumulative[-1])))
+        return samples
+
+
+class MetricCallback:
+    def __init__(self, name, help, labels, collect, kind='gauge'):
+        # collect() -> {label values tuple: value}, evaluated at scrape time
+        self.name, self.help, self.labels, self.collect, self.kind = name, help, labels, collect, kind
+        METRICS.append(self)
+
+    def samples(self):
+        return [(self.name, labels, (), value) for labels, value in self.collect().items()]
+
+
+def format_metric_value(value):
+    value = float(value)
+    if np.isnan(value):
+        return 'NaN'
+    if np.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return str(int(value)) if value.is_integer() and abs(value) < 2 ** 53 else repr(value)
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        try:
+            samples = metric.samples()
+        except Exception as e:
+            print(f"Error collecting metric {metric.name}: {e}")
+            continue
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, extra, value in samples:
+            lines.append(f"{name}{format_labels(metric.labels, labels, extra)} {format_metric_value(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+REQUEST_LATENCY = Histogram('stockai_http_request_duration_seconds', 'Time to build the response, per route.', ('route', 'method', 'status'))
+RESPONSE_SIZE = Histogram('stockai_http_response_size_bytes', 'Response body size, per route.', ('route',), SIZE_BUCKETS)
+STAGE_LATENCY = Histogram('stockai_stage_duration_seconds', 'Time spent in each stage of a request; stages nest (store includes upstream).', ('route', 'stage'))
+UPSTREAM_LATENCY = Histogram('stockai_upstream_call_duration_seconds', 'Duration of each upstream attempt, per akshare function.', ('function',))
+UPSTREAM_ERRORS = Counter('stockai_upstream_errors_total', 'Upstream calls that did not return data, by reason.', ('function', 'reason'))
+UPSTREAM_RETRY_COUNT = Counter('stockai_upstream_retries_total', 'Upstream attempts retried after an error.', ('function',))
+UPSTREAM_STALE = Counter('stockai_upstream_stale_responses_total', 'Last good responses served instead of an upstream error.', ('function',))
+
+# --- Request tracing ---
+# Stages are always timed into STAGE_LATENCY; with ?trace=1 (or STOCKAI_TRACE=1 for every
+# request) they are also returned in a Server-Timing header, which browser dev tools show
+# per request, e.g. "upstream;dur=812.4, store;dur=815.0, serialize;dur=3.1".
+TRACE_ALL_REQUESTS = os.environ.get('STOCKAI_TRACE', '0') == '1'
+_trace_local = threading.local()
+
+@contextmanager
+def stage(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages = getattr(_trace_local, 'stages', None)
+        if stages is not None:
+            stages[name] = stages.get(name, 0.0) + time.perf_counter() - started
+
+# --- Upstream calls ---
+# Every akshare call runs on a bounded thread pool with a per-call timeout, so a slow
+# Eastmoney response costs the caller at most UPSTREAM_TIMEOUT seconds and at most
+# UPSTREAM_WORKERS upstream requests are ever in flight, however many clients are connected.
+UPSTREAM_WORKERS = int(os.environ.get('STOCKAI_UPSTREAM_WORKERS', '8'))
+UPSTREAM_TIMEOUT = float(os.environ.get('STOCKAI_UPSTREAM_TIMEOUT', '15')) # 秒
+
+upstream_pool = ThreadPoolExecutor(max_workers=UPSTREAM_WORKERS, thread_name_prefix='upstream')
+
+class UpstreamTimeout(Exception):
+    pass
+
+
+class UpstreamUnavailable(Exception):
+    # Circuit open or rate limit exhausted, and nothing cached to fall back on -> 503
+    pass
+
+
+def call_upstream(fn, *args, timeout=None, **kwargs):
+    timeout = UPSTREAM_TIMEOUT if timeout is None else timeout
+    future = upstream_pool.submit(fn, *args, **kwargs)
+    try:
+        return future.result(timeout=timeout)
+    except FuturesTimeoutError:
+        future.cancel() # only helps if it is still queued; a running call finishes in the pool
+        raise UpstreamTimeout(f"{getattr(fn, '__name__', fn)} 超过 {timeout:g} 秒未响应")
+
+# --- Upstream client ---
+# All akshare traffic goes through `upstream`: a token bucket shared by every endpoint, and
+# by every process using the same data directory (ASGI workers, the fetcher, prefetch), keeps
+# us under Eastmoney's throttling threshold, failed calls are retried with full-jitter
+# exponential backoff within the caller's UPSTREAM_TIMEOUT budget, and each endpoint has a
+# circuit breaker. While a breaker is open (or a call still fails after its retries) the
+# last good response for the same arguments is served instead of an error.
+UPSTREAM_RATE = float(os.environ.get('STOCKAI_UPSTREAM_RATE', '5')) # 每秒请求数，0 = 不限
+UPSTREAM_BURST = int(os.environ.get('STOCKAI_UPSTREAM_BURST', '10'))
+UPSTREAM_RETRIES = int(os.environ.get('STOCKAI_UPSTREAM_RETRIES', '2'))
+UPSTREAM_RETRY_BASE = 0.5 # 秒
+UPSTREAM_RETRY_CAP = 8 # 秒
+BREAKER_THRESHOLD = int(os.environ.get('STOCKAI_BREAKER_THRESHOLD', '5')) # 连续失败次数
+BREAKER_RESET = float(os.environ.get('STOCKAI_BREAKER_RESET', '30')) # 熔断后多久放行一次试探请求，秒
+UPSTREAM_STALE_ENTRIES = 256 # last good responses kept per endpoint
+UPSTREAM_BUCKET_FILE = os.path.join(os.environ.get('STOCKAI_DATA_DIR', 'data'), 'upstream.bucket')
+
+try:
+    import fcntl
+except ImportError: # Windows: the bucket is per process
+    fcntl = None
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout):
+        # True once a token is taken, False if none frees up within `timeout` seconds
+        if self.rate <= 0:
+            return True
+        deadline = time.monotonic() + timeout
+        while True:
+            wait = self._take()
+            if wait == 0:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def _take(self):
+        # 0 once a token is taken, else the seconds until one frees up
+        with self._lock:
+            now = time.monotonic()
+            self.tokens, wait = self._refill(self.tokens, now - self.updated)
+            self.updated = now
+            return wait
+
+    def _refill(self, tokens, elapsed):
+        tokens = min(self.burst, tokens + max(elapsed, 0) * self.rate)
+        if tokens >= 1:
+            return tokens - 1, 0
+        return tokens, (1 - tokens) / self.rate
+
+
+class FileTokenBucket(TokenBucket):
+    # The same bucket kept in a 16-byte file (tokens, wall-clock time of the last update) and
+    # updated under flock, so separate processes draw from one budget
+    STATE = struct.Struct('<dd')
+
+    def __init__(self, rate, burst, path):
+        super().__init__(rate, burst)
+        self.path = path
+        self._fd = None
+        self._pid = None
+
+    def _take(self):
+        with self._lock:
+            if self._pid != os.getpid(): # a forked child must not share the parent's open file
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                self._pid = os.getpid()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                state = os.pread(self._fd, self.STATE.size, 0)
+                now = time.time()
+                tokens, updated = self.STATE.unpack(state) if len(state) == self.STATE.size else (float(self.burst), now)
+                tokens, wait = self._refill(tokens, now - updated)
+                os.pwrite(self._fd, self.STATE.pack(tokens, now), 0)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            return wait
+
+
+class CircuitBreaker:
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset_timeout=BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half_open' if self.probing else 'open'
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.probing = True # half-open: exactly one call finds out whether upstream is back
+            return True
+
+    def retry_in(self):
+        return 0 if self.opened_at is None else max(0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def release(self):
+        with self._lock:
+            self.probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.probing = False
+            if self.opened_at is not None or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+class FakeUpstreamBackend:
+    # Offline stand-in for the akshare module (STOCKAI_UPSTREAM_BACKEND=fake): same function
+    # names and columns, deterministic prices, optional latency and failure injection.
+    def __init__(self, symbols=5000, latency=0.0, failure_rate=0.0, seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.seed = seed
+        prefixes = ('60', '00', '30', '68')
+        self.codes = [f"{prefixes[i % 4]}{i // 4 + 1:04d}" for i in range(symbols)]
+        self.names = [f"测试股份{i:04d}" for i in range(symbols)]
+        self.base = 5 + np.arange(symbols) % 997 / 10
+
+    def _call(self):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise ConnectionError("fake upstream failure")
+
+    def stock_zh_a_spot_em(self):
+        self._call()
+        tick = int(time.time() // 3) # moves every 3 seconds like a live session
+        rng = np.random.default_rng([self.seed, tick])
+        prev_close = self.base
+        change = rng.normal(0, 2, len(self.codes)).clip(-10, 10)
+        price = (prev_close * (1 + change / 100)).round(2)
+        volume = rng.integers(10_000, 10_000_000, len(self.codes)) * 100
+        return pd.DataFrame({
+            '序号': np.arange(1, len(self.codes) + 1), '代码': self.codes, '名称': self.names,
+            '最新价': price, '涨跌幅': change.round(2), '涨跌额': (price - prev_close).round(2),
+            '成交量': volume, '成交额': volume * price, '振幅': np.abs(change).round(2),
+            '最高': np.maximum(price, prev_close), '最低': np.minimum(price, prev_close),
+            '今开': prev_close, '昨收': prev_close, '量比': 1.0, '换手率': rng.uniform(0, 10, len(self.codes)).round(2),
+            '市盈率-动态': 20.0, '市净率': 2.0, '总市值': price * 1e9, '流通市值': price * 8e8,
+            '涨速': 0.0, '5分钟涨跌': 0.0, '60日涨跌幅': 0.0, '年初至今涨跌幅': 0.0,
+        })
+
+    def stock_zh_a_hist(self, symbol, period='daily', start_date='19700101', end_date='20500101', adjust='', **kwargs):
+        self._call()
+        days = pd.bdate_range(max(pd.Timestamp(start_date), pd.Timestamp('2015-01-05')),
+                              min(pd.Timestamp(end_date), pd.Timestamp(market_now().date())))
+        if len(days) == 0:
+            return pd.DataFrame()
+        # Prices depend only on the date, so any window of the same symbol agrees with any other
+        ordinal = days.to_numpy().astype('datetime64[D]').astype('int64')
+        phase = int(symbol) % 97
+        hfq = 1.5 * (10 + phase / 10) * np.exp(0.1 * np.sin(ordinal / 23 + phase) + 0.0002 * (ordinal - 16000))
+        # One 除权除息 a year on a per-symbol day: the raw price drops 2% for good from then on,
+        # and qfq is anchored at today's factor like upstream's
+        factor = 1.02 ** ((ordinal - phase) // 365)
+        latest = 1.02 ** ((np.datetime64(market_now().date(), 'D').astype('int64') - phase) // 365)
+        close = {'': hfq / factor, 'qfq': hfq / latest, 'hfq': hfq}[adjust]
+        open_ = close * (1 + 0.005 * np.sin(ordinal / 3))
+        return pd.DataFrame({
+            '日期': days.date, '股票代码': symbol, '开盘': open_.round(2), '收盘': close.round(2),
+            '最高': (np.maximum(open_, close) * 1.01).round(2), '最低': (np.minimum(open_, close) * 0.99).round(2),
+            '成交量': 1000 + ordinal % 500 * 100, '成交额': close * 1e7, '振幅': 2.0, '涨跌幅': 0.0, '涨跌额': 0.0, '换手率': 1.0,
+        })
+
+    def stock_fuzzy_search(self, keyword):
+        self._call()
+        rows = [(code, name, 'A股', 'SH' if code.startswith('6') else 'SZ')
+                for code, name in zip(self.codes, self.names) if keyword in code or keyword in name]
+        return pd.DataFrame(rows[:50], columns=['代码', '名称', '类型', '市场'])
+
+    def tool_trade_date_hist_sina(self):
+        self._call()
+        return pd.DataFrame({'trade_date': pd.bdate_range('2015-01-05', f"{market_now().year}-12-31").date})
+
+
+# Fixtures for offline runs: STOCKAI_UPSTREAM_BACKEND=record passes calls through to akshare
+# and saves each response under STOCKAI_FIXTURE_DIR; =replay serves them back with a simulated
+# latency (STOCKAI_REPLAY_LATENCY: "0.2" for every function, or per function such as
+# "stock_zh_a_spot_em=1.5,stock_zh_a_hist=0.3,*=0.1"). Layout:
+#   stock_zh_a_spot_em/00001.pkl ...        every recorded snapshot, replayed in a loop
+#   stock_zh_a_hist/<代码>.<复权>.pkl        all recorded days merged, sliced per request
+#   stock_fuzzy_search/<keyword>.pkl
+#   tool_trade_date_hist_sina/calendar.pkl
+# Fixtures are pandas pickles: only replay directories you recorded yourself.
+FIXTURE_DIR = os.environ.get('STOCKAI_FIXTURE_DIR', os.path.join(os.environ.get('STOCKAI_DATA_DIR', 'data'), 'fixtures'))
+
+def fixture_name(value):
+    safe = re.sub(r'[^\w-]', '_', value)
+    return safe if safe == value else f"{safe}-{hashlib.sha1(value.encode('utf-8')).hexdigest()[:8]}"
+
+def parse_latency(spec):
+    latency = {}
+    for part in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, seconds = part.rpartition('=')
+        latency[name or '*'] = float(seconds)
+    return latency
+
+
+class RecordingUpstreamBackend:
+    def __init__(self, inner, fixture_dir):
+        self.inner = inner
+        self.fixture_dir = fixture_dir
+        self._lock = threading.Lock()
+
+    def _path(self, endpoint, name):
+        return os.path.join(self.fixture_dir, endpoint, name)
+
+    def _save(self, path, df):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        df.to_pickle(tmp_path, compression=None)
+        os.replace(tmp_path, path)
+
+    def stock_zh_a_spot_em(self):
+        df = self.inner.stock_zh_a_spot_em()
+        with self._lock:
+            directory = os.path.join(self.fixture_dir, 'stock_zh_a_spot_em')
+            os.makedirs(directory, exist_ok=True)
+            self._save(os.path.join(directory, f"{len(os.listdir(directory)) + 1:05d}.pkl"), df)
+        return df
+
+    def stock_zh_a_hist(self, symbol, period='daily', start_date='19700101', end_date='20500101', adjust='', **kwargs):
+        df = self.inner.stock_zh_a_hist(symbol=symbol, period=period, start_date=start_date, end_date=end_date, adjust=adjust, **kwargs)
+        if period == 'daily' and df is not None and not df.empty:
+            path = self._path('stock_zh_a_hist', f"{fixture_name(symbol)}.{adjust or 'none'}.pkl")
+            with self._lock:
+                if os.path.exists(path):
+                    # One file per symbol covering every day seen; the newest response wins
+                    merged = pd.concat([pd.read_pickle(path, compression=None), df])
+                    merged['日期'] = pd.to_datetime(merged['日期']).dt.date
+                    merged = merged.drop_duplicates(subset='日期', keep='last').sort_values('日期')
+                    self._save(path, merged.reset_index(drop=True))
+                else:
+                    self._save(path, df)
+        return df
+
+    def stock_fuzzy_search(self, keyword):
+        df = self.inner.stock_fuzzy_search(keyword=keyword)
+        with self._lock:
+            self._save(self._path('stock_fuzzy_search', f"{fixture_name(keyword)}.pkl"), df)
+        return df
+
+    def tool_trade_date_hist_sina(self):
+        df = self.inner.tool_trade_date_hist_sina()
+        with self._lock:
+            self._save(self._path('tool_trade_date_hist_sina', 'calendar.pkl'), df)
+        return df
+
+
+class ReplayUpstreamBackend:
+    def __init__(self, fixture_dir, latency=None):
+        self.fixture_dir = fixture_dir
+        self.latency = latency or {}
+        spot_dir = os.path.join(fixture_dir, 'stock_zh_a_spot_em')
+        self._spot = sorted(os.path.join(spot_dir, name) for name in os.listdir(spot_dir)) if os.path.isdir(spot_dir) else []
+        self._spot_next = 0
+        self._frames = {} # path -> DataFrame, each fixture read once
+        self._lock = threading.Lock()
+
+    def _delay(self, endpoint):
+        seconds = self.latency.get(endpoint, self.latency.get('*', 0))
+        if seconds:
+            time.sleep(seconds)
+
+    def _load(self, path):
+        with self._lock:
+            df = self._frames.get(path)
+            if df is None and os.path.exists(path):
+                df = self._frames[path] = pd.read_pickle(path, compression=None)
+        return df
+
+    def stock_zh_a_spot_em(self):
+        self._delay('stock_zh_a_spot_em')
+        if not self._spot:
+            raise LookupError(f"no recorded stock_zh_a_spot_em fixtures in {self.fixture_dir}")
+        with self._lock:
+            path = self._spot[self._spot_next % len(self._spot)]
+            self._spot_next += 1
+        return self._load(path).copy() # a new object per call, like a fresh download
+
+    def stock_zh_a_hist(self, symbol, period='daily', start_date='19700101', end_date='20500101', adjust='', **kwargs):
+        self._delay('stock_zh_a_hist')
+        df = self._load(os.path.join(self.fixture_dir, 'stock_zh_a_hist', f"{fixture_name(symbol)}.{adjust or 'none'}.pkl"))
+        if df is None or period != 'daily':
+            return pd.DataFrame()
+        dates = pd.to_datetime(df['日期'])
+        return df[(dates >= pd.Timestamp(start_date)) & (dates <= pd.Timestamp(end_date))].reset_index(drop=True)
+
+    def stock_fuzzy_search(self, keyword):
+        self._delay('stock_fuzzy_search')
+        df = self._load(os.path.join(self.fixture_dir, 'stock_fuzzy_search', f"{fixture_name(keyword)}.pkl"))
+        return pd.DataFrame(columns=['代码', '名称', '类型', '市场']) if df is None else df.copy()
+
+    def tool_trade_date_hist_sina(self):
+        self._delay('tool_trade_date_hist_sina')
+        df = self._load(os.path.join(self.fixture_dir, 'tool_trade_date_hist_sina', 'calendar.pkl'))
+        if df is None:
+            raise LookupError(f"no recorded tool_trade_date_hist_sina fixture in {self.fixture_dir}")
+        return df.copy()
+
+
+UPSTREAM_BACKENDS = {
+    'akshare': lambda: ak,
+    'fake': lambda: FakeUpstreamBackend(latency=float(os.environ.get('STOCKAI_FAKE_LATENCY', '0')),
+                                        failure_rate=float(os.environ.get('STOCKAI_FAKE_FAILURE_RATE', '0'))),
+    'record': lambda: RecordingUpstreamBackend(ak, FIXTURE_DIR),
+    'replay': lambda: ReplayUpstreamBackend(FIXTURE_DIR, parse_latency(os.environ.get('STOCKAI_REPLAY_LATENCY', '0'))),
+}
+
+
+class UpstreamClient:
+    def __init__(self, backend):
+        self.backend = backend # anything with akshare's function names; swappable at runtime
+        if fcntl is None:
+            self.bucket = TokenBucket(UPSTREAM_RATE, UPSTREAM_BURST)
+        else:
+            self.bucket = FileTokenBucket(UPSTREAM_RATE, UPSTREAM_BURST, UPSTREAM_BUCKET_FILE)
+        self.breakers = {}
+        self._last_good = {} # endpoint -> OrderedDict(arguments -> response)
+        self._lock = threading.Lock()
+
+    def breaker(self, endpoint):
+        with self._lock:
+            return self.breakers.setdefault(endpoint, CircuitBreaker())
+
+    def call(self, endpoint, **kwargs):
+        key = tuple(sorted(kwargs.items()))
+        try:
+            with stage('upstream'):
+                value = self._call(endpoint, kwargs)
+        except Exception as e:
+            with self._lock:
+                stale = self._last_good.get(endpoint, {}).get(key)
+            if stale is None:
+                raise
+            UPSTREAM_STALE.inc(endpoint)
+            print(f"Upstream {endpoint} unavailable ({e}); serving the last good response.")
+            return stale
+        with self._lock:
+            last_good = self._last_good.setdefault(endpoint, OrderedDict())
+            last_good[key] = value
+            last_good.move_to_end(key)
+            while len(last_good) > UPSTREAM_STALE_ENTRIES:
+                last_good.popitem(last=False)
+        return value
+
+    def _call(self, endpoint, kwargs):
+        breaker = self.breaker(endpoint)
+        if not breaker.allow():
+            UPSTREAM_ERRORS.inc(endpoint, 'circuit_open')
+            raise UpstreamUnavailable(f"{endpoint} 连续失败，{breaker.retry_in():.0f} 秒后重试")
+        deadline = time.monotonic() + UPSTREAM_TIMEOUT
+        attempt = 0
+        while True:
+            if not self.bucket.acquire(deadline - time.monotonic()):
+                breaker.release() # never reached upstream: neither a success nor a failure
+                UPSTREAM_ERRORS.inc(endpoint, 'rate_limited')
+                raise UpstreamUnavailable(f"{endpoint} 请求过于频繁，已限流")
+            started = time.perf_counter()
+            try:
+                value = call_upstream(getattr(self.backend, endpoint), timeout=max(deadline - time.monotonic(), 0.1), **kwargs)
+                UPSTREAM_LATENCY.observe(endpoint, value=time.perf_counter() - started)
+                breaker.record_success()
+                return value
+            except UpstreamTimeout:
+                UPSTREAM_LATENCY.observe(endpoint, value=time.perf_counter() - started)
+                UPSTREAM_ERRORS.inc(endpoint, 'timeout')
+                breaker.record_failure() # the slow call keeps running in the pool; don't pile on
+                raise
+            except Exception as e:
+                UPSTREAM_LATENCY.observe(endpoint, value=time.perf_counter() - started)
+                UPSTREAM_ERRORS.inc(endpoint, 'error')
+                attempt += 1
+                delay = random.uniform(0, min(UPSTREAM_RETRY_CAP, UPSTREAM_RETRY_BASE * 2 ** attempt))
+                if attempt > UPSTREAM_RETRIES or time.monotonic() + delay >= deadline:
+                    breaker.record_failure()
+                    raise
+                UPSTREAM_RETRY_COUNT.inc(endpoint)
+                print(f"Upstream {endpoint} failed ({e}), retry {attempt}/{UPSTREAM_RETRIES} in {delay:.1f}s")
+                time.sleep(delay)
+
+
+upstream = UpstreamClient(UPSTREAM_BACKENDS[os.environ.get('STOCKAI_UPSTREAM_BACKEND', 'akshare')]())
+
+# --- Spot snapshot cache ---
+# ak.stock_zh_a_spot_em() downloads the whole A-share market (~5000 rows) every time it is
+# called. Keep one shared copy for SPOT_CACHE_TTL seconds; concurrent callers that find the
+# cache expired wait on the single in-flight fetch instead of each starting their own.
+SPOT_CACHE_TTL = float(os.environ.get('STOCKAI_SPOT_TTL', '10')) # 秒
+
+class SnapshotUnavailable(Exception):
+    pass
+
+
+class SpotSnapshot:
+    def __init__(self, df, fetched_at=None, previous=None):
+        self.fetched_at = fetched_at if fetched_at is not None else time.time()
+        self.source = df # the upstream response, to recognise it if it is served again
+        frame = df.copy()
+        frame['代码'] = frame['代码'].astype(str)
+        frame = frame.drop_duplicates(subset='代码')
+        # Column-typed copy for whole-market scans (screener): numbers coerced to float64 once
+        # here, on the fetching thread, so queries are pure numpy over aligned arrays.
+        self.columns = {}
+        for column in frame.columns:
+            if column in ('代码', '名称'):
+                self.columns[column] = frame[column].astype(str).to_numpy(dtype=object)
+            else:
+                self.columns[column] = pd.to_numeric(frame[column], errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+        self._index(previous)
+
+    @classmethod
+    def from_columns(cls, columns, fetched_at, previous=None):
+        # Wrap already-typed arrays (e.g. shared-memory views) without copying them
+        snapshot = cls.__new__(cls)
+        snapshot.fetched_at = fetched_at
+        snapshot.source = None
+        snapshot.columns = columns
+        snapshot._index(previous)
+        return snapshot
+
+    def _index(self, previous):
+        # Index by code so a lookup is a hash probe instead of a boolean mask over every row
+        self.frame = pd.DataFrame(self.columns, copy=False).set_index('代码', drop=False)
+        self.symbols = self.frame[['代码', '名称']].reset_index(drop=True)
+        if previous is not None and previous.symbols.equals(self.symbols):
+            # Same universe as before: keep the old object so consumers can compare by identity
+            self.symbols = previous.symbols
+
+    def age(self):
+        return time.time() - self.fetched_at
+
+    def locate(self, codes):
+        # One vectorized index probe for any number of codes; returns (rows, missing codes)
+        positions = self.frame.index.get_indexer(codes)
+        found = positions >= 0
+        missing = [code for code, ok in zip(codes, found) if not ok]
+        return self.frame.iloc[positions[found]], missing
+
+    def take(self, positions):
+        # Rows by position as {column: array}, accepted by quote_records like a frame slice
+        return {column: values[positions] for column, values in self.columns.items()}
+
+
+class SpotSnapshotCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        # Set while a SnapshotRefresher owns the upstream fetches: readers then always get the
+        # current snapshot, however old, and never call akshare themselves.
+        self.background = False
+        self._snapshot = None
+        self._inflight = None # Future of the fetch currently running, if any
+        self._lock = threading.Lock()
+        self._listeners = []
+        self.stats = {'hit': 0, 'miss': 0}
+
+    def subscribe(self, listener):
+        # listener(old_snapshot, new_snapshot) runs on the fetching thread after every swap
+        self._listeners.append(listener)
+
+    def _fresh(self):
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.age() < self.ttl:
+            return snapshot
+        return None
+
+    def current(self):
+        return self._snapshot
+
+    def get(self):
+        snapshot = self._snapshot
+        if snapshot is not None and (self.background or snapshot.age() < self.ttl):
+            self.stats['hit'] += 1
+            return snapshot
+        self.stats['miss'] += 1
+        if self.background:
+            raise SnapshotUnavailable("行情快照尚未就绪，请稍后再试")
+        return self.refresh(force=False)
+
+    def refresh(self, force=True):
+        with self._lock:
+            snapshot = None if force else self._fresh()
+            if snapshot is not None:
+                return snapshot
+            future = self._inflight
+            leader = future is None
+            if leader:
+                future = self._inflight = Future()
+        if not leader:
+            return future.result() # re-raises the leader's exception, if any
+        try:
+            # Build the new snapshot off to the side; readers keep using the old one until
+            # the single reference assignment below swaps it in.
+            previous = self._snapshot
+            df = upstream.call('stock_zh_a_spot_em') #东财实时行情
+            if previous is not None and df is previous.source:
+                # Upstream is down and the client fell back to the response the current snapshot
+                # was built from: keep that snapshot and its real age rather than re-stamp it
+                snapshot = previous
+            else:
+                snapshot = SpotSnapshot(df, previous=previous)
+                self._snapshot = snapshot
+            future.set_result(snapshot)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight = None
+        if snapshot is not previous:
+            self._notify(previous, snapshot)
+        return snapshot
+
+    def swap(self, snapshot):
+        # Install a snapshot built elsewhere (e.g. read from shared memory) in place of a fetch
+        previous = self._snapshot
+        self._snapshot = snapshot
+        self._notify(previous, snapshot)
+
+    def _notify(self, previous, snapshot):
+        for listener in self._listeners:
+            try:
+                listener(previous, snapshot)
+            except Exception as e:
+                print(f"Spot snapshot listener {getattr(listener, '__name__', listener)} failed: {e}")
+
+
+spot_cache = SpotSnapshotCache(SPOT_CACHE_TTL)
+
+# --- Trading calendar ---
+# Exchange holidays (春节, 国庆 ...) fall on weekdays, and on those days upstream keeps serving
+# the last session's frozen table. Trade dates come from tool_trade_date_hist_sina, which
+# already lists the rest of the current year, and are saved to data/trade_dates.json; the
+# snapshot refresher fetches them again once they stop covering today, other processes pick
+# the file up from disk. Without a calendar every weekday counts as a trading day.
+TRADE_CALENDAR_FILE = os.path.join(os.environ.get('STOCKAI_DATA_DIR', 'data'), 'trade_dates.json')
+TRADE_CALENDAR_RETRY = 3600 # 秒，日历未覆盖今天时重新拉取的间隔
+TRADE_CALENDAR_RELOAD = 60 # 秒，日历过期时重新读取文件的间隔
+
+class TradingCalendar:
+    def __init__(self, path):
+        self.path = path
+        self.dates = None # sorted datetime64[D]
+        self.mtime = None
+        self.reloaded_at = None
+        self.fetched_at = None
+        self._lock = threading.Lock()
+
+    def covers(self, day):
+        return self.dates is not None and len(self.dates) > 0 and self.dates[-1] >= np.datetime64(day, 'D')
+
+    def reload(self):
+        # Called with the lock held
+        self.reloaded_at = time.monotonic()
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self.mtime:
+                return
+            with open(self.path, encoding='utf-8') as f:
+                dates = np.array(json.load(f)['dates'], dtype='datetime64[D]')
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring unreadable trade calendar {self.path}: {e}")
+            return
+        self.dates, self.mtime = np.sort(dates), mtime
+
+    def is_trading_day(self, day):
+        with self._lock:
+            if not self.covers(day) and (self.reloaded_at is None or time.monotonic() - self.reloaded_at >= TRADE_CALENDAR_RELOAD):
+                self.reload()
+            if not self.covers(day):
+                return day.weekday() < 5
+            dates = self.dates
+        position = np.searchsorted(dates, np.datetime64(day, 'D'))
+        return bool(dates[position] == np.datetime64(day, 'D'))
+
+    def refresh(self, today=None):
+        # Off the request path (snapshot refresher): fetch the calendar if it does not cover today
+        today = today or market_now().date()
+        with self._lock:
+            self.reload()
+            if self.covers(today) or (self.fetched_at is not None and time.monotonic() - self.fetched_at < TRADE_CALENDAR_RETRY):
+                return
+            self.fetched_at = time.monotonic()
+        try:
+            df = upstream.call('tool_trade_date_hist_sina')
+            dates = np.sort(pd.to_datetime(df['trade_date']).to_numpy().astype('datetime64[D]'))
+        except Exception as e:
+            print(f"Error fetching the trade calendar, treating every weekday as a trading day: {e}")
+            return
+        if len(dates) == 0:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"dates": [str(day) for day in dates]}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Error saving the trade calendar to {self.path}: {e}")
+        with self._lock:
+            self.dates = dates
+            self.mtime = None
+
+
+trading_calendar = TradingCalendar(TRADE_CALENDAR_FILE)
+
+# --- Background snapshot refresher ---
+# Polls the spot table on a schedule that follows the exchange session so request handlers
+# only ever read the last completed snapshot.
+MARKET_TZ = ZoneInfo('Asia/Shanghai')
+TRADING_SESSIONS = ((dtime(9, 15), dtime(11, 30)), (dtime(13, 0), dtime(15, 0))) # 含集合竞价
+REFRESH_INTERVAL = float(os.environ.get('STOCKAI_REFRESH_INTERVAL', '3')) # 交易时段内，秒
+IDLE_REFRESH_INTERVAL = float(os.environ.get('STOCKAI_IDLE_REFRESH_INTERVAL', '900')) # 非交易时段上限，秒
+
+def market_now():
+    return datetime.now(MARKET_TZ)
+
+def in_trading_session(now=None):
+    now = now or market_now()
+    if not trading_calendar.is_trading_day(now.date()):
+        return False
+    t = now.time()
+    return any(start <= t <= end for start, end in TRADING_SESSIONS)
+
+def seconds_until_next_session(now=None):
+    now = now or market_now()
+    for offset in range(16): # 春节 and 国庆 close the market for up to 9 days in a row
+        day = (now + timedelta(days=offset)).date()
+        if not trading_calendar.is_trading_day(day):
+            continue
+        for start, _ in TRADING_SESSIONS:
+            opens = datetime.combine(day, start, tzinfo=MARKET_TZ)
+            if opens > now:
+                return (opens - now).total_seconds()
+    return IDLE_REFRESH_INTERVAL
+
+
+class SnapshotRefresher(threading.Thread):
+    def __init__(self, cache):
+        super().__init__(name='spot-snapshot-refresher', daemon=True)
+        self.cache = cache
+        self._stop_event = threading.Event()
+
+    def next_delay(self, now=None):
+        now = now or market_now()
+        if in_trading_session(now):
+            return REFRESH_INTERVAL
+        # Outside the session the table barely changes: sleep until the next open, but wake up
+        # now and then so post-close corrections still land.
+        return max(REFRESH_INTERVAL, min(seconds_until_next_session(now), IDLE_REFRESH_INTERVAL))
+
+    def run(self):
+        failures = 0
+        while not self._stop_event.is_set():
+            trading_calendar.refresh()
+            try:
+                self.cache.refresh()
+                failures = 0
+                delay = self.next_delay()
+            except Exception as e:
+                failures += 1
+                delay = min(REFRESH_INTERVAL * 2 ** failures, IDLE_REFRESH_INTERVAL)
+                print(f"Spot snapshot refresh failed ({failures} in a row), retrying in {delay:.0f}s: {e}")
+            self._stop_event.wait(delay)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+snapshot_refresher = None
+
+def start_snapshot_refresher():
+    global snapshot_refresher
+    if snapshot_refresher is None:
+        spot_cache.background = True
+        snapshot_refresher = SnapshotRefresher(spot_cache)
+        snapshot_refresher.start()
+    return snapshot_refresher
+
+# --- Quote conversion ---
+# API field -> (spot table column, conversion). Conversions run column-wise over however many
+# rows were selected: non-numeric and NaN values become None, ints are truncated like int().
+QUOTE_FIELDS = {
+    "code": ('代码', 'str'),
+    "name": ('名称', 'str'),
+    "price": ('最新价', 'float'),
+    "change_amount": ('涨跌额', 'float'),
+    "change_percent": ('涨跌幅', 'float'),
+    "volume": ('成交量', 'int'), # 单位：股
+    "turnover": ('成交额', 'float'), # 单位：元
+    "open": ('今开', 'float'),
+    "high": ('最高', 'float'),
+    "low": ('最低', 'float'),
+    "prev_close": ('昨收', 'float'),
+}
+
+def convert_column(values, kind):
+    if kind == 'str':
+        return values.astype(str).tolist()
+    if isinstance(values, np.ndarray) and values.dtype == np.float64:
+        numeric = values # already coerced, e.g. a K-line store column
+    else:
+        numeric = pd.to_numeric(values, errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+    missing = np.isnan(numeric)
+    if kind == 'int':
+        converted = np.where(missing, 0, numeric).astype('int64').astype(object) # int() truncates too
+    else:
+        converted = numeric.astype(object)
+    converted[missing] = None
+    return converted.tolist()
+
+def quote_records(rows, fields, table=QUOTE_FIELDS):
+    columns = [convert_column(rows[table[field][0]], table[field][1]) for field in fields]
+    return [dict(zip(fields, values)) for values in zip(*columns)]
+
+# --- Screener ---
+# Filter / sort / top-N over the whole spot snapshot, e.g.
+#   where=涨跌幅 > 5 and 成交额 > 1e8 & sort=turnover & limit=50
+# Predicates are parsed (never eval'd) into (column, comparison, value) clauses and run as
+# boolean masks over SpotSnapshot.columns, so a query costs a few array passes and no I/O.
+SCREENER_FIELDS = {
+    **QUOTE_FIELDS,
+    "amplitude": ('振幅', 'float'), # %
+    "volume_ratio": ('量比', 'float'),
+    "turnover_rate": ('换手率', 'float'), # %
+    "pe": ('市盈率-动态', 'float'),
+    "pb": ('市净率', 'float'),
+    "market_cap": ('总市值', 'float'), # 元
+    "float_market_cap": ('流通市值', 'float'), # 元
+    "speed": ('涨速', 'float'),
+    "change_5min": ('5分钟涨跌', 'float'),
+    "change_60d": ('60日涨跌幅', 'float'),
+    "change_ytd": ('年初至今涨跌幅', 'float'),
+}
+SCREENER_DEFAULT_LIMIT = 50
+SCREENER_MAX_LIMIT = 500
+SCREENER_MAX_CLAUSES = 20
+SCREENER_OPS = {'>': np.greater, '>=': np.greater_equal, '<': np.less, '<=': np.less_equal,
+                '=': np.equal, '==': np.equal, '!=': np.not_equal}
+SCREENER_CLAUSE = re.compile(r'^\s*(.+?)\s*(>=|<=|==|!=|=|>|<)\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*$')
+
+class ScreenerError(ValueError):
+    pass
+
+
+def screener_column(name, snapshot):
+    # API field name (turnover) or the spot table's own column name (成交额)
+    column = SCREENER_FIELDS[name][0] if name in SCREENER_FIELDS else name
+    if column not in snapshot.columns or column in ('代码', '名称'):
+        raise ScreenerError(f"未知或非数值字段: {name}")
+    return column
+
+def parse_screener_query(where, snapshot):
+    clauses = [part for part in re.split(r'\s+and\s+|\s*&&\s*|\s*;\s*', where.strip(), flags=re.IGNORECASE) if part]
+    if len(clauses) > SCREENER_MAX_CLAUSES:
+        raise ScreenerError(f"筛选条件过多 (最多 {SCREENER_MAX_CLAUSES} 个)")
+    compiled = []
+    for clause in clauses:
+        match = SCREENER_CLAUSE.match(clause)
+        if not match:
+            raise ScreenerError(f"无法解析筛选条件: {clause}")
+        name, op, value = match.groups()
+        compiled.append((screener_column(name, snapshot), SCREENER_OPS[op], float(value)))
+    return compiled
+
+def screen_snapshot(snapshot, clauses, sort_column=None, descending=True, limit=SCREENER_DEFAULT_LIMIT):
+    # -> (positions of the top `limit` matching rows in sort order, number of matches)
+    mask = np.ones(len(snapshot.frame), dtype=bool)
+    for column, op, value in clauses:
+        values = snapshot.columns[column]
+        mask &= op(values, value) & ~np.isnan(values) # NaN (停牌、无数据) never matches
+    matched = np.flatnonzero(mask)
+    if sort_column is None:
+        return matched[:limit], len(matched)
+    keys = snapshot.columns[sort_column][matched]
+    keys = np.where(np.isnan(keys), np.inf, -keys if descending else keys) # NaN sorts last
+    if limit < len(keys):
+        top = np.argpartition(keys, limit - 1)[:limit]
+        order = top[np.argsort(keys[top], kind='stable')]
+    else:
+        order = np.argsort(keys, kind='stable')
+    return matched[order], len(matched)
+
+# --- Watchlists ---
+# Named code lists for /api/realtime/batch, read from a JSON file such as
+# {"自选": ["600519", "000001"]}. The file is re-read when its mtime changes.
+WATCHLIST_FILE = os.environ.get('STOCKAI_WATCHLISTS', 'watchlists.json')
+MAX_BATCH_CODES = 500
+_watchlists = {'mtime': None, 'lists': {}}
+
+def load_watchlists():
+    try:
+        mtime = os.path.getmtime(WATCHLIST_FILE)
+    except OSError:
+        return {}
+    if _watchlists['mtime'] != mtime:
+        with open(WATCHLIST_FILE, encoding='utf-8') as f:
+            lists = json.load(f)
+        _watchlists['lists'] = {name: [str(code) for code in codes] for name, codes in lists.items()}
+        _watchlists['mtime'] = mtime
+    return _watchlists['lists']
+
+def is_stock_code(code):
+    return isinstance(code, str) and code.isdigit() and len(code) == 6
+
+def resolve_request_codes(codes, watchlist=''):
+    # Returns (codes, error message, HTTP status); codes plus the named watchlist, de-duplicated
+    codes = [str(code).strip() for code in codes if str(code).strip()]
+    watchlist = watchlist.strip()
+    if watchlist:
+        try:
+            lists = load_watchlists()
+        except Exception as e:
+            print(f"Error loading watchlists from {WATCHLIST_FILE}: {e}")
+            return None, f"读取自选股列表失败: {str(e)}", 500
+        if watchlist not in lists:
+            return None, f"未找到自选股列表 '{watchlist}'", 404
+        codes = codes + lists[watchlist]
+    codes = list(dict.fromkeys(codes)) # 去重并保持顺序
+    if not codes:
+        return None, "请提供股票代码列表 (codes) 或自选股列表名称 (watchlist)", 400
+    invalid = [code for code in codes if not is_stock_code(code)]
+    if invalid:
+        return None, f"无效的股票代码格式: {', '.join(invalid[:10])}", 400
+    if len(codes) > MAX_BATCH_CODES:
+        return None, f"单次最多查询 {MAX_BATCH_CODES} 只股票", 400
+    return codes, None, 200
+
+# --- Local daily K-line store ---
+# One memory-mapped .npy file per symbol holding unadjusted (不复权) daily bars plus each bar's
+# 后复权 factor (hfq price / raw price). 前复权, 后复权 and unadjusted series are all derived
+# from it: hfq = raw * factor, qfq = raw * factor / latest factor. Past raw prices and factors
+# never change, so a 除权除息 only adds bars with a new factor instead of invalidating the
+# stored series. A request only fetches the bars after the last stored one.
+DATA_DIR = os.environ.get('STOCKAI_DATA_DIR', 'data')
+KLINE_DIR = os.path.join(DATA_DIR, 'kline')
+KLINE_RECHECK_INTERVAL = float(os.environ.get('STOCKAI_KLINE_RECHECK', '60')) # 秒
+HISTORY_DAYS = 3 * 365 # 图表默认展示近三年
+KLINE_DTYPE = np.dtype([
+    ('date', 'datetime64[D]'),
+    ('open', 'f8'),
+    ('close', 'f8'),
+    ('high', 'f8'),
+    ('low', 'f8'),
+    ('volume', 'f8'), # 单位：手，float 以便用 NaN 表示缺失
+])
+RAW_KLINE_DTYPE = np.dtype(KLINE_DTYPE.descr + [('factor', 'f8')]) # 后复权因子
+ADJUST_MODES = ('qfq', 'hfq', 'none') # 前复权、后复权、不复权
+ADJUST_CACHE_SIZE = int(os.environ.get('STOCKAI_ADJUST_CACHE_SIZE', '1000')) # 缓存的复权序列数
+# Relative tolerance when checking that a stored bar still matches upstream
+ADJUST_TOLERANCE = 1e-6
+
+def hist_frame_to_bars(df):
+    bars = np.empty(len(df), dtype=KLINE_DTYPE)
+    bars['date'] = pd.to_datetime(df['日期']).to_numpy().astype('datetime64[D]')
+    for field, column in (('open', '开盘'), ('close', '收盘'), ('high', '最高'), ('low', '最低'), ('volume', '成交量')):
+        bars[field] = pd.to_numeric(df[column], errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+    return bars
+
+def hist_frames_to_raw_bars(raw_df, hfq_df):
+    prices = hist_frame_to_bars(raw_df)
+    hfq = hist_frame_to_bars(hfq_df)
+    bars = np.empty(len(prices), dtype=RAW_KLINE_DTYPE)
+    for field in KLINE_DTYPE.names:
+        bars[field] = prices[field]
+    # Factors from the closes; a date missing from the hfq series borrows its neighbour's factor
+    positions = np.searchsorted(hfq['date'], prices['date']).clip(max=len(hfq) - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        factor = np.where(hfq['date'][positions] == prices['date'], hfq['close'][positions] / prices['close'], np.nan)
+    factor = pd.Series(np.where(np.isfinite(factor), factor, np.nan)).ffill().bfill().to_numpy()
+    if np.isnan(factor).any():
+        raise ValueError("后复权数据缺失，无法计算复权因子")
+    bars['factor'] = factor
+    return bars
+
+def adjust_bars(raw, adjust):
+    # Vectorized: one multiply per price column, rounded to 分 like upstream's adjusted prices
+    bars = np.empty(len(raw), dtype=KLINE_DTYPE)
+    bars['date'] = raw['date']
+    bars['volume'] = raw['volume']
+    if adjust == 'none' or len(raw) == 0:
+        scale = None
+    elif adjust == 'hfq':
+        scale = raw['factor']
+    else:
+        scale = raw['factor'] / raw['factor'][-1]
+    for field in ('open', 'close', 'high', 'low'):
+        bars[field] = raw[field] if scale is None else np.round(raw[field] * scale, 2)
+    return bars
+
+# --- History serialization ---
+# Bars are serialized column by column straight from the NumPy arrays, then encoded with
+# orjson when it is installed. format=columns returns {"date": [...], "open": [...], ...}
+# which the chart consumes directly; the default is the original list of per-bar objects.
+HISTORY_FIELDS = (('open', 'float'), ('close', 'float'), ('low', 'float'), ('high', 'float'), ('volume', 'int'))
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def dumps_json(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def json_response(obj, status=200):
+    with stage('serialize'):
+        return app.response_class(dumps_json(obj), status=status, mimetype='application/json')
+
+def bars_to_columns(bars):
+    columns = {"date": np.datetime_as_string(bars['date'], unit=np.datetime_data(bars.dtype['date'])[0]).tolist()}
+    for field, kind in HISTORY_FIELDS:
+        columns[field] = convert_column(np.ascontiguousarray(bars[field]), kind)
+    return columns
+
+def bars_to_records(bars):
+    columns = bars_to_columns(bars)
+    return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+# --- K-line windows and downsampling ---
+# /api/history can return any date window and cap the number of bars. Reductions keep OHLC
+# semantics: a rolled-up bar opens at its first bar's open, closes at its last bar's close,
+# spans the highest high and lowest low, and sums the volume. Everything is np.reduceat over
+# group boundaries, so no Python loop touches individual bars.
+KLINE_PERIODS = ('daily', 'weekly', 'monthly')
+MAX_HISTORY_POINTS = 5000
+
+def parse_date_param(value):
+    for fmt in ('%Y-%m-%d', '%Y%m%d'):
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            pass
+    raise ValueError(f"无效的日期: {value}，请使用 YYYY-MM-DD 或 YYYYMMDD")
+
+def window_bounds(dates, start, end):
+    lo = np.searchsorted(dates, np.datetime64(start, 'D'), side='left')
+    hi = np.searchsorted(dates, np.datetime64(end, 'D'), side='right')
+    return lo, hi
+
+def slice_bars(bars, start, end):
+    lo, hi = window_bounds(bars['date'], start, end)
+    return bars[lo:hi]
+
+def period_keys(dates, period):
+    if period == 'weekly':
+        # 1970-01-01 was a Thursday; shifting by 3 days makes weeks start on Monday
+        return (dates.astype('int64') + 3) // 7
+    if period == 'monthly':
+        return dates.astype('datetime64[M]').astype('int64')
+    raise ValueError(period)
+
+def aggregate_bars(bars, starts):
+    # starts: index of the first bar of each group; each rolled-up bar is dated by its last bar
+    ends = np.r_[starts[1:], len(bars)] - 1
+    out = np.empty(len(starts), dtype=bars.dtype)
+    out['date'] = bars['date'][ends]
+    out['open'] = bars['open'][starts]
+    out['close'] = bars['close'][ends]
+    out['high'] = np.fmax.reduceat(np.ascontiguousarray(bars['high']), starts)
+    out['low'] = np.fmin.reduceat(np.ascontiguousarray(bars['low']), starts)
+    out['volume'] = np.add.reduceat(np.nan_to_num(bars['volume']), starts)
+    return out
+
+def rollup_bars(bars, period):
+    if period == 'daily' or len(bars) == 0:
+        return bars
+    keys = period_keys(bars['date'], period)
+    return aggregate_bars(bars, np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]))
+
+def downsample_bars(bars, points, period='daily'):
+    # Coarsen to the first calendar period that fits in `points` bars; windows too wide even
+    # for monthly bars fall back to equal-size buckets of consecutive bars.
+    bars = rollup_bars(bars, period)
+    for coarser in KLINE_PERIODS[KLINE_PERIODS.index(period):]:
+        if len(bars) <= points:
+            return bars, period
+        bars, period = rollup_bars(bars, coarser), coarser
+    if len(bars) <= points:
+        return bars, period
+    bucket = -(-len(bars) // points) # ceil
+    return aggregate_bars(bars, np.arange(0, len(bars), bucket)), f"{period}x{bucket}"
+
+
+class KlineStore:
+    def __init__(self, root):
+        self.root = root
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._checked = {} # code -> time of the last upstream check
+        self._adjusted = OrderedDict() # (code, adjust) -> (file version, derived bars)
+        self._adjusted_lock = threading.Lock()
+        self.stats = {'hit': 0, 'update': 0, 'rewrite': 0, 'stale': 0}
+        self.adjust_stats = {'hit': 0, 'miss': 0}
+
+    def path(self, code):
+        return os.path.join(self.root, f"{code}.raw.npy")
+
+    def _lock(self, key):
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _version(self, code):
+        try:
+            return os.stat(self.path(code)).st_mtime_ns
+        except OSError:
+            return None
+
+    def load_raw(self, code):
+        try:
+            return np.load(self.path(code), mmap_mode='r')
+        except FileNotFoundError:
+            return None
+
+    def load(self, code, adjust):
+        # The whole stored series in the given mode, without checking upstream
+        version = self._version(code)
+        raw = self.load_raw(code)
+        return None if raw is None else self.adjusted(code, adjust, raw, version)
+
+    def adjusted(self, code, adjust, raw, version):
+        # Memoized per (symbol, mode) until the raw file changes; entries are shared, so read-only
+        if version is None or len(raw) == 0:
+            return adjust_bars(raw, adjust)
+        key = (code, adjust)
+        with self._adjusted_lock:
+            entry = self._adjusted.get(key)
+            if entry is not None and entry[0] == version:
+                self._adjusted.move_to_end(key)
+                self.adjust_stats['hit'] += 1
+                return entry[1]
+        self.adjust_stats['miss'] += 1
+        bars = adjust_bars(raw, adjust)
+        bars.flags.writeable = False
+        with self._adjusted_lock:
+            self._adjusted[key] = (version, bars)
+            self._adjusted.move_to_end(key)
+            while len(self._adjusted) > ADJUST_CACHE_SIZE:
+                self._adjusted.popitem(last=False)
+        return bars
+
+    def modified(self, code):
+        # When the stored series last changed, for Last-Modified
+        version = self._version(code)
+        return None if version is None else datetime.fromtimestamp(version / 1e9, tz=MARKET_TZ)
+
+    def covered_from(self, code):
+        # First date the stored series is complete from; a stock listed later than that simply
+        # has no earlier bars, which must not trigger a re-download on every request
+        try:
+            with open(self.path(code)[:-len('.npy')] + '.json', encoding='utf-8') as f:
+                return np.datetime64(json.load(f)['covered_from'], 'D')
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def write(self, code, bars, covered_from):
+        os.makedirs(self.root, exist_ok=True)
+        path = self.path(code)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, bars)
+        os.replace(tmp_path, path) # readers holding the old mmap keep a consistent file
+        meta_path = path[:-len('.npy')] + '.json'
+        meta_tmp_path = f"{meta_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(meta_tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"covered_from": str(covered_from)}, f)
+        os.replace(meta_tmp_path, meta_path)
+
+    def fetch(self, code, start, end):
+        # Unadjusted bars plus the hfq closes for their factors: two calls serve all three modes
+        window = dict(symbol=code, period="daily", start_date=start.strftime('%Y%m%d'), end_date=end.strftime('%Y%m%d'))
+        raw_df = upstream.call('stock_zh_a_hist', adjust='', **window)
+        if raw_df is None or raw_df.empty:
+            return np.empty(0, dtype=RAW_KLINE_DTYPE)
+        hfq_df = upstream.call('stock_zh_a_hist', adjust='hfq', **window)
+        if hfq_df is None or hfq_df.empty:
+            raise ValueError(f"{code} 的后复权数据为空，无法计算复权因子")
+        return hist_frames_to_raw_bars(raw_df, hfq_df)
+
+    def get_daily(self, code, adjust, start, end, fallback=True):
+        start = np.datetime64(start, 'D')
+        raw, version = self.get_raw(code, start, end, fallback)
+        bars = self.adjusted(code, adjust, raw, version)
+        return bars[bars['date'] >= start]
+
+    def get_raw(self, code, start, end, fallback=True):
+        # -> (raw bars covering `start`..`end`, version of the stored file)
+        start = np.datetime64(start, 'D')
+        with self._lock(code):
+            stored = self.load_raw(code)
+            covered_from = self.covered_from(code)
+            # Every update rewrites the file, so its mtime is when any process last checked upstream
+            version = self._version(code)
+            checked = max(self._checked.get(code, 0), 0 if version is None else version / 1e9)
+            recently_checked = time.time() - checked < KLINE_RECHECK_INTERVAL
+            try:
+                if stored is None or len(stored) < 2 or covered_from is None or covered_from > start:
+                    self.stats['rewrite'] += 1
+                    bars = self._rewrite(code, start, end)
+                    self._checked[code] = time.time()
+                elif recently_checked or stored['date'][-1] >= np.datetime64(end, 'D'):
+                    self.stats['hit'] += 1
+                    bars = stored
+                else:
+                    self.stats['update'] += 1
+                    bars = self._update(code, stored, covered_from, end)
+                    self._checked[code] = time.time()
+            except Exception as e:
+                if not fallback or stored is None or len(stored) == 0:
+                    raise
+                # Upstream is failing: the stored series is the last good data we have
+                self.stats['stale'] += 1
+                print(f"K-line store: serving stored {code} bars, upstream failed: {e}")
+                bars = stored
+            return bars, self._version(code)
+
+    def _update(self, code, stored, covered_from, end):
+        # Re-fetch from the second-to-last stored bar: that bar is final and neither its raw
+        # prices nor its factor change later, so if it no longer matches upstream the history
+        # itself was corrected and the whole series is rewritten. The last stored bar may have
+        # been an intraday snapshot and is always replaced.
+        anchor = stored[-2]
+        fresh = self.fetch(code, anchor['date'].astype(object), end)
+        if len(fresh) == 0 or fresh['date'][0] != anchor['date']:
+            print(f"K-line store: cannot verify {code} against upstream, rewriting.")
+            return self._rewrite(code, covered_from, end)
+        fields = ('open', 'close', 'high', 'low', 'factor')
+        expected = np.array([anchor[field] for field in fields])
+        actual = np.array([fresh[0][field] for field in fields])
+        if not np.allclose(actual, expected, rtol=ADJUST_TOLERANCE, equal_nan=True):
+            print(f"K-line store: stored bars of {code} no longer match upstream, rewriting.")
+            return self._rewrite(code, covered_from, end)
+        bars = np.concatenate([stored[:-1], fresh[1:]])
+        self.write(code, bars, covered_from)
+        return bars
+
+    def _rewrite(self, code, start, end):
+        bars = self.fetch(code, start.astype(object), end)
+        if len(bars):
+            self.write(code, bars, start)
+        return bars
+
+
+kline_store = KlineStore(KLINE_DIR)
+
+# --- Technical indicators ---
+# Computed server-side over the K-line store's daily bars. Kernels work along the last axis,
+# so the same code runs on one symbol's bars or a (symbols x days) block: rolling windows are
+# cumulative sums / sliding-window views, recursive averages loop over time only.
+# Results are cached per (symbol, adjust, indicator, params) together with the indicator's
+# internal state, so one new (or revised last) bar is a single O(window) step instead of a
+# recomputation of the whole series. Conventions follow 通达信/东方财富 (EMA seeded with the
+# first close, RSI/KDJ smoothed with SMA(X, N, 1)).
+INDICATOR_CACHE_SIZE = int(os.environ.get('STOCKAI_INDICATOR_CACHE_SIZE', '5000'))
+MAX_INDICATORS_PER_REQUEST = 10
+
+def rolling_mean(x, n):
+    out = np.full(x.shape, np.nan)
+    if x.shape[-1] >= n:
+        c = np.cumsum(x, axis=-1)
+        c = np.concatenate([np.zeros(x.shape[:-1] + (1,)), c], axis=-1)
+        out[..., n - 1:] = (c[..., n:] - c[..., :-n]) / n
+    return out
+
+def rolling_std(x, n):
+    out = np.full(x.shape, np.nan)
+    if x.shape[-1] >= n:
+        out[..., n - 1:] = np.lib.stride_tricks.sliding_window_view(x, n, axis=-1).std(axis=-1)
+    return out
+
+def rolling_extreme(x, n, ufunc):
+    # Like 通达信 HHV/LLV: the first n-1 bars use however many bars exist so far
+    out = np.empty(x.shape)
+    head = min(n - 1, x.shape[-1])
+    out[..., :head] = ufunc.accumulate(x[..., :head], axis=-1)
+    if x.shape[-1] >= n:
+        out[..., n - 1:] = ufunc.reduce(np.lib.stride_tricks.sliding_window_view(x, n, axis=-1), axis=-1)
+    return out
+
+def ewm(x, alpha, initial=None):
+    # y[t] = alpha * x[t] + (1 - alpha) * y[t-1]; y[-1] = initial, or y[0] = x[0] without one
+    if x.ndim == 1:
+        # One series: plain floats are far cheaper per step than 0-d NumPy operations
+        values = x.tolist()
+        prev = values[0] if initial is None else initial
+        for t, value in enumerate(values):
+            prev = values[t] = alpha * value + (1 - alpha) * prev
+        return np.array(values)
+    out = np.empty(x.shape)
+    prev = x[..., 0] if initial is None else initial
+    for t in range(x.shape[-1]):
+        prev = out[..., t] = alpha * x[..., t] + (1 - alpha) * prev
+    return out
+
+
+class Indicator:
+    name = None
+    defaults = ()
+
+    def compute(self, bars, *params):
+        # -> (outputs: name -> array over all bars, (state before last bar, state after it))
+        raise NotImplementedError
+
+    def step(self, bars, state, *params):
+        # bars ends with the new bar; -> (outputs for it, state after it)
+        raise NotImplementedError
+
+
+class MA(Indicator):
+    name = 'ma'
+    defaults = (5,)
+
+    def compute(self, bars, n):
+        return {'ma': rolling_mean(bars['close'], n)}, ((), ()) # stateless: a step only needs the bars
+
+    def step(self, bars, state, n):
+        close = bars['close']
+        return {'ma': close[-n:].mean() if len(close) >= n else np.nan}, ()
+
+
+class EMA(Indicator):
+    name = 'ema'
+    defaults = (12,)
+
+    def compute(self, bars, n):
+        ema = ewm(bars['close'], 2 / (n + 1))
+        return {'ema': ema}, (ema[..., -2].copy() if ema.shape[-1] > 1 else None, ema[..., -1].copy())
+
+    def step(self, bars, state, n):
+        alpha = 2 / (n + 1)
+        ema = alpha * bars['close'][-1] + (1 - alpha) * state
+        return {'ema': ema}, ema
+
+
+class MACD(Indicator):
+    name = 'macd'
+    defaults = (12, 26, 9)
+
+    def compute(self, bars, fast, slow, signal):
+        close = bars['close']
+        fast_ema, slow_ema = ewm(close, 2 / (fast + 1)), ewm(close, 2 / (slow + 1))
+        dif = fast_ema - slow_ema
+        dea = ewm(dif, 2 / (signal + 1))
+        def state_at(i):
+            return fast_ema[..., i].copy(), slow_ema[..., i].copy(), dea[..., i].copy()
+        states = (state_at(-2) if close.shape[-1] > 1 else None, state_at(-1))
+        return {'dif': dif, 'dea': dea, 'macd': 2 * (dif - dea)}, states
+
+    def step(self, bars, state, fast, slow, signal):
+        close = bars['close'][-1]
+        fast_ema, slow_ema, dea = state
+        fast_ema = fast_ema + 2 / (fast + 1) * (close - fast_ema)
+        slow_ema = slow_ema + 2 / (slow + 1) * (close - slow_ema)
+        dif = fast_ema - slow_ema
+        dea = dea + 2 / (signal + 1) * (dif - dea)
+        return {'dif': dif, 'dea': dea, 'macd': 2 * (dif - dea)}, (fast_ema, slow_ema, dea)
+
+
+class RSI(Indicator):
+    name = 'rsi'
+    defaults = (14,)
+
+    def compute(self, bars, n):
+        close = bars['close']
+        rsi = np.full(close.shape, np.nan)
+        if close.shape[-1] < 2:
+            return {'rsi': rsi}, (None, None)
+        diff = np.diff(close, axis=-1)
+        gain = ewm(np.maximum(diff, 0), 1 / n)
+        total = ewm(np.abs(diff), 1 / n)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rsi[..., 1:] = gain / total * 100
+        states = ((gain[..., -2].copy(), total[..., -2].copy()) if diff.shape[-1] > 1 else None,
+                  (gain[..., -1].copy(), total[..., -1].copy()))
+        return {'rsi': rsi}, states
+
+    def step(self, bars, state, n):
+        diff = bars['close'][-1] - bars['close'][-2]
+        if state is None: # second bar ever: seeds the averages
+            gain, total = max(diff, 0), abs(diff)
+        else:
+            gain, total = state
+            gain = gain + (max(diff, 0) - gain) / n
+            total = total + (abs(diff) - total) / n
+        return {'rsi': gain / total * 100 if total else np.nan}, (gain, total)
+
+
+class BOLL(Indicator):
+    name = 'boll'
+    defaults = (20, 2.0)
+
+    def compute(self, bars, n, k):
+        mid = rolling_mean(bars['close'], n)
+        std = rolling_std(bars['close'], n)
+        return {'mid': mid, 'upper': mid + k * std, 'lower': mid - k * std}, ((), ())
+
+    def step(self, bars, state, n, k):
+        window = bars['close'][-n:]
+        if len(window) < n:
+            return {'mid': np.nan, 'upper': np.nan, 'lower': np.nan}, ()
+        mid, std = window.mean(), window.std()
+        return {'mid': mid, 'upper': mid + k * std, 'lower': mid - k * std}, ()
+
+
+class KDJ(Indicator):
+    name = 'kdj'
+    defaults = (9, 3, 3)
+
+    @staticmethod
+    def rsv(close, high, low):
+        spread = high - low
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(spread > 0, (close - low) / np.where(spread > 0, spread, 1) * 100, 50.0) # 无波动时取中值
+
+    def compute(self, bars, n, m1, m2):
+        rsv = self.rsv(bars['close'], rolling_extreme(bars['high'], n, np.fmax), rolling_extreme(bars['low'], n, np.fmin))
+        k = ewm(rsv, 1 / m1, initial=50.0)
+        d = ewm(k, 1 / m2, initial=50.0)
+        states = ((k[..., -2].copy(), d[..., -2].copy()) if rsv.shape[-1] > 1 else (50.0, 50.0),
+                  (k[..., -1].copy(), d[..., -1].copy()))
+        return {'k': k, 'd': d, 'j': 3 * k - 2 * d}, states
+
+    def step(self, bars, state, n, m1, m2):
+        rsv = float(self.rsv(bars['close'][-1], np.nanmax(bars['high'][-n:]), np.nanmin(bars['low'][-n:])))
+        k, d = state
+        k = k + (rsv - k) / m1
+        d = d + (k - d) / m2
+        return {'k': k, 'd': d, 'j': 3 * k - 2 * d}, (k, d)
+
+
+INDICATORS = {indicator.name: indicator for indicator in (MA(), EMA(), MACD(), RSI(), BOLL(), KDJ())}
+
+def parse_indicator_spec(spec):
+    # "macd" / "ma:20" / "boll:20:2" -> (Indicator, params); missing params take the defaults
+    name, *values = spec.strip().lower().split(':')
+    indicator = INDICATORS.get(name)
+    if indicator is None:
+        raise ValueError(f"未知指标: {name}，可选 {', '.join(INDICATORS)}")
+    if len(values) > len(indicator.defaults):
+        raise ValueError(f"指标 {name} 最多 {len(indicator.defaults)} 个参数")
+    params = []
+    for default, value in zip(indicator.defaults, values + [None] * len(indicator.defaults)):
+        param = default if value in (None, '') else type(default)(value)
+        if not np.isfinite(param) or param <= 0:
+            raise ValueError(f"指标 {name} 的参数必须为有限的正数")
+        params.append(param)
+    return indicator, tuple(params)
+
+
+class IndicatorCache:
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hit': 0, 'step': 0, 'full': 0}
+
+    def get(self, code, adjust, indicator, params, bars):
+        key = (code, adjust, indicator.name, params)
+        bars = np.asarray(bars)
+        n = len(bars)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None and n >= 2 and entry['first_date'] == bars['date'][0]:
+            same_date = entry['length'] == n and entry['last_date'] == bars['date'][-1]
+            if same_date and self._same(entry['last_close'], bars['close'][-1]):
+                self.stats['hit'] += 1
+                return entry['outputs']
+            if same_date and entry['state_prev'] is not None and self._same(entry['prev_close'], bars['close'][-2]):
+                # The last bar was revised (intraday): redo just that step
+                return self._step(key, entry, indicator, params, bars, entry['state_prev'], replace=True)
+            if entry['length'] == n - 1 and entry['last_date'] == bars['date'][-2] \
+                    and self._same(entry['last_close'], bars['close'][-2]):
+                return self._step(key, entry, indicator, params, bars, entry['state'], replace=False)
+        self.stats['full'] += 1
+        outputs, (state_prev, state) = indicator.compute(bars, *params)
+        self._store(key, bars, outputs, state_prev, state)
+        return outputs
+
+    @staticmethod
+    def _same(a, b):
+        return a == b or (np.isnan(a) and np.isnan(b))
+
+    def _step(self, key, entry, indicator, params, bars, state_before, replace):
+        self.stats['step'] += 1
+        row, state = indicator.step(bars, state_before, *params)
+        kept = slice(None, -1) if replace else slice(None)
+        outputs = {name: np.append(values[kept], row[name]) for name, values in entry['outputs'].items()}
+        self._store(key, bars, outputs, state_before, state)
+        return outputs
+
+    def _store(self, key, bars, outputs, state_prev, state):
+        entry = {
+            'length': len(bars),
+            'first_date': bars['date'][0],
+            'last_date': bars['date'][-1],
+            'last_close': bars['close'][-1],
+            'prev_close': bars['close'][-2] if len(bars) > 1 else np.nan,
+            'outputs': outputs,
+            'state_prev': state_prev,
+            'state': state,
+        }
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+indicator_cache = IndicatorCache(INDICATOR_CACHE_SIZE)
+
+# --- A-share symbol list ---
+# The code/name universe is persisted to disk so startup loads it in milliseconds instead of
+# waiting for a full stock_zh_a_spot_em() download. A background thread refreshes it with
+# backoff; a failed or suspiciously short fetch never replaces a good list.
+SYMBOL_LIST_FILE = os.path.join(DATA_DIR, 'stock_list.json')
+SYMBOL_LIST_VERSION = 1
+SYMBOL_LIST_REFRESH_INTERVAL = float(os.environ.get('STOCKAI_SYMBOL_REFRESH_INTERVAL', str(6 * 3600))) # 秒
+SYMBOL_LIST_RETRY_BASE = 5 # 秒
+SYMBOL_LIST_MIN_RATIO = 0.5 # a new list shorter than this fraction of the old one is treated as partial
+
+stock_list_df = None
+stock_list_fetched_at = None
+_stock_list_lock = threading.Lock()
+
+def empty_stock_list():
+    return pd.DataFrame(columns=['代码', '名称'])
+
+def load_stock_list(path=SYMBOL_LIST_FILE):
+    try:
+        with open(path, encoding='utf-8') as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return None, None
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable A-share list {path}: {e}")
+        return None, None
+    if saved.get('version') != SYMBOL_LIST_VERSION:
+        print(f"Ignoring A-share list {path} with version {saved.get('version')}")
+        return None, None
+    df = pd.DataFrame(saved['stocks'], columns=['代码', '名称'], dtype=str)
+    return df, saved['fetched_at']
+
+def save_stock_list(df, fetched_at, path=SYMBOL_LIST_FILE):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    saved = {
+        "version": SYMBOL_LIST_VERSION,
+        "fetched_at": fetched_at,
+        "count": len(df),
+        "stocks": df[['代码', '名称']].astype(str).values.tolist(),
+    }
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(saved, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def update_stock_list(df, fetched_at, persist=True):
+    global stock_list_df, stock_list_fetched_at
+    if df is None or df.empty:
+        return False
+    with _stock_list_lock:
+        if stock_list_df is not None and len(df) < SYMBOL_LIST_MIN_RATIO * len(stock_list_df):
+            print(f"Refusing to replace {len(stock_list_df)} A-share entries with only {len(df)}.")
+            return False
+        changed = stock_list_df is None or not stock_list_df.equals(df)
+        if changed:
+            stock_list_df = df
+        stock_list_fetched_at = fetched_at
+        if persist:
+            try:
+                save_stock_list(stock_list_df, fetched_at)
+            except OSError as e:
+                print(f"Error saving A-share list to {SYMBOL_LIST_FILE}: {e}")
+    if changed:
+        get_search_index() # rebuild here, off the request path
+    return True
+
+def refresh_stock_list():
+    snapshot = spot_cache.get()
+    if stock_list_fetched_at == snapshot.fetched_at:
+        return stock_list_df # already taken from this snapshot by update_stock_list_on_swap
+    if not update_stock_list(snapshot.symbols, snapshot.fetched_at):
+        raise ValueError(f"stock_zh_a_spot_em returned an unusable list ({len(snapshot.symbols)} entries)")
+    return stock_list_df
+
+
+class StockListRefresher(threading.Thread):
+    def __init__(self):
+        super().__init__(name='stock-list-refresher', daemon=True)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        failures = 0
+        while not self._stop_event.is_set():
+            try:
+                refresh_stock_list()
+                failures = 0
+                delay = SYMBOL_LIST_REFRESH_INTERVAL
+            except Exception as e:
+                failures += 1
+                delay = min(SYMBOL_LIST_RETRY_BASE * 2 ** failures, SYMBOL_LIST_REFRESH_INTERVAL)
+                delay *= random.uniform(0.5, 1.0)
+                print(f"Error refreshing A-share list ({failures} in a row), retrying in {delay:.0f}s: {e}")
+            self._stop_event.wait(delay)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+stock_list_refresher = None
+
+def start_stock_list_refresher():
+    global stock_list_refresher
+    with _stock_list_lock:
+        if stock_list_refresher is None:
+            stock_list_refresher = StockListRefresher()
+            stock_list_refresher.start()
+    return stock_list_refresher
+
+def get_stock_list_cached():
+    # Never waits for upstream: returns the persisted list (or an empty frame on a cold start
+    # without one) and leaves fetching to the background refresher.
+    global stock_list_df, stock_list_fetched_at
+    if stock_list_df is None:
+        with _stock_list_lock:
+            if stock_list_df is None:
+                df, fetched_at = load_stock_list()
+                if df is not None and not df.empty:
+                    stock_list_df, stock_list_fetched_at = df, fetched_at
+                    print(f"Loaded {len(df)} A-share stock entries from {SYMBOL_LIST_FILE}.")
+        if shared_follower is None: # a follower gets the list from the fetcher process instead
+            start_stock_list_refresher()
+    return stock_list_df if stock_list_df is not None else empty_stock_list()
+
+
+# --- Symbol search index ---
+# Prebuilt over the code/name universe so a lookup is a few dict probes: a code prefix trie,
+# a name prefix trie, unigram/bigram postings for substring matches, pinyin initials
+# (e.g. "gzmt" -> 贵州茅台, needs the optional pypinyin package) and a ranked fuzzy fallback.
+SEARCH_DEFAULT_LIMIT = 10
+SEARCH_MAX_LIMIT = 50
+MAX_PINYIN_VARIANTS = 8 # 多音字组合上限
+
+try:
+    from pypinyin import pinyin as _pinyin, Style as _PinyinStyle
+except ImportError:
+    _pinyin = None
+
+def normalize_search_text(text):
+    # NFKC folds full-width letters (万科Ａ -> 万科A); case and spaces do not matter
+    return unicodedata.normalize('NFKC', str(text)).lower().replace(' ', '')
+
+def pinyin_initials(name):
+    if _pinyin is None:
+        return []
+    variants = ['']
+    for options in _pinyin(name, style=_PinyinStyle.FIRST_LETTER, heteronym=True):
+        options = list(dict.fromkeys(normalize_search_text(option) for option in options))
+        variants = [prefix + option for prefix in variants for option in options][:MAX_PINYIN_VARIANTS]
+    return [''.join(ch for ch in variant if ch.isalnum()) for variant in variants]
+
+
+class PrefixTrie:
+    def __init__(self):
+        self.root = {}
+
+    def add(self, key, item):
+        node = self.root
+        for ch in key:
+            node = node.setdefault(ch, {})
+            items = node.setdefault(None, [])
+            if not items or items[-1] != item:
+                items.append(item)
+
+    def find(self, prefix):
+        node = self.root
+        for ch in prefix:
+            node = node.get(ch)
+            if node is None:
+                return []
+        return node.get(None, [])
+
+
+class SymbolSearchIndex:
+    # Match scores; higher ranks first, ties go to the shorter name, then the lower code
+    SCORE_CODE = 100
+    SCORE_NAME = 95
+    SCORE_CODE_PREFIX = 80
+    SCORE_PINYIN = 75
+    SCORE_NAME_PREFIX = 70
+    SCORE_PINYIN_PREFIX = 65
+    SCORE_NAME_CONTAINS = 60
+    SCORE_FUZZY = 50 # scaled by the similarity ratio
+    FUZZY_CUTOFF = 0.5
+
+    def __init__(self, symbols):
+        self.symbols = symbols
+        symbols = symbols.sort_values('代码')
+        self.codes = symbols['代码'].astype(str).tolist()
+        self.names = symbols['名称'].astype(str).tolist()
+        self.keys = [normalize_search_text(name) for name in self.names]
+        self.code_trie = PrefixTrie()
+        self.name_trie = PrefixTrie()
+        self.pinyin_trie = PrefixTrie()
+        self.exact_names = {}
+        self.exact_pinyin = {}
+        self.grams = {} # unigrams and bigrams of each name -> set of ids
+        for i, (code, key) in enumerate(zip(self.codes, self.keys)):
+            self.code_trie.add(code, i)
+            self.name_trie.add(key, i)
+            self.exact_names.setdefault(key, []).append(i)
+            for gram in set(key) | {key[j:j + 2] for j in range(len(key) - 1)}:
+                self.grams.setdefault(gram, set()).add(i)
+            for initials in pinyin_initials(self.names[i]):
+                self.pinyin_trie.add(initials, i)
+                self.exact_pinyin.setdefault(initials, []).append(i)
+
+    @property
+    def empty(self):
+        return not self.codes
+
+    def search(self, query, limit=SEARCH_DEFAULT_LIMIT):
+        q = normalize_search_text(query)
+        if not q or self.empty:
+            return []
+        scores = {}
+        matches = {}
+        def offer(ids, score, match):
+            for i in ids:
+                if scores.get(i, -1) < score:
+                    scores[i] = score
+                    matches[i] = match
+
+        if q.isdigit():
+            code_ids = self.code_trie.find(q)
+            offer(code_ids[:limit], self.SCORE_CODE if len(q) == 6 else self.SCORE_CODE_PREFIX, 'code')
+        offer(self.exact_names.get(q, []), self.SCORE_NAME, 'name')
+        offer(self.name_trie.find(q)[:limit], self.SCORE_NAME_PREFIX, 'name')
+        if q.isascii() and q.isalnum():
+            offer(self.exact_pinyin.get(q, []), self.SCORE_PINYIN, 'pinyin')
+            offer(self.pinyin_trie.find(q)[:limit], self.SCORE_PINYIN_PREFIX, 'pinyin')
+        if len(scores) < limit:
+            offer(self._containing(q), self.SCORE_NAME_CONTAINS, 'name')
+        if not scores and not q.isdigit():
+            self._fuzzy(q, offer)
+
+        ranked = sorted(scores, key=lambda i: (-scores[i], len(self.names[i]), self.codes[i]))[:limit]
+        return [{"code": self.codes[i], "name": self.names[i], "match": matches[i], "score": round(scores[i], 2)}
+                for i in ranked]
+
+    def _containing(self, q):
+        grams = [q[j:j + 2] for j in range(len(q) - 1)] or [q]
+        postings = []
+        for gram in grams:
+            ids = self.grams.get(gram)
+            if not ids:
+                return []
+            postings.append(ids)
+        postings.sort(key=len)
+        ids = set.intersection(*postings) if len(postings) > 1 else postings[0]
+        # Bigram hits can come from different places in the name; confirm the substring
+        return sorted(i for i in ids if q in self.keys[i])
+
+    def _fuzzy(self, q, offer):
+        candidates = set()
+        for ch in set(q):
+            candidates |= self.grams.get(ch, set())
+        for i in candidates:
+            ratio = difflib.SequenceMatcher(None, q, self.keys[i]).ratio()
+            if ratio >= self.FUZZY_CUTOFF:
+                offer([i], self.SCORE_FUZZY * ratio, 'fuzzy')
+
+
+search_index = None
+_search_index_lock = threading.Lock()
+
+def get_search_index():
+    global search_index
+    symbols = get_stock_list_cached()
+    index = search_index
+    if index is None or index.symbols is not symbols:
+        with _search_index_lock:
+            index = search_index
+            if index is None or index.symbols is not symbols:
+                index = search_index = SymbolSearchIndex(symbols)
+    return index
+
+def update_stock_list_on_swap(previous, snapshot):
+    # Every snapshot carries the full universe; pick up listings as soon as they appear
+    if shared_follower is not None:
+        return # the fetcher process publishes the symbol table on its own channel
+    if previous is None or previous.symbols is not snapshot.symbols:
+        update_stock_list(snapshot.symbols, snapshot.fetched_at)
+
+spot_cache.subscribe(update_stock_list_on_swap)
+
+
+# --- Shared-memory snapshot ---
+# Multi-process mode: one fetcher process (--server fetcher, or the one --workers starts)
+# makes every upstream call and publishes each spot snapshot and symbol-list change into
+# shared memory; worker processes attach to it instead of fetching for themselves.
+#
+# Each channel ("spot", "symbols") has a small control block {prefix}.{channel} holding a
+# sequence number, the current generation and its fetch time. Every generation is written
+# once into its own segment {prefix}.{channel}.{generation} and never modified afterwards:
+# a header, a JSON column layout, then float64 columns and string columns (UTF-8 blob plus
+# int64 offsets). The control block is updated seqlock-style (seq odd while writing), so a
+# reader retries until it sees the same even seq before and after reading the generation.
+# Numeric columns are attached as read-only views; only strings are decoded per process.
+SHARED_SNAPSHOT = os.environ.get('STOCKAI_SHARED_SNAPSHOT', '') # 共享内存名前缀，空 = 各进程自行获取
+SHARED_POLL_INTERVAL = float(os.environ.get('STOCKAI_SHARED_POLL_INTERVAL', '0.2')) # 秒
+SHARED_KEEP_GENERATIONS = 2 # segments kept linked so a reader that just saw a generation can still open it
+SHARED_CONTROL_DTYPE = np.dtype([('seq', '<u8'), ('generation', '<u8'), ('fetched_at', '<f8')])
+SHARED_HEADER = np.dtype([('generation', '<u8'), ('layout_size', '<u8')])
+
+def create_shared_memory(name, size):
+    try:
+        return shared_memory.SharedMemory(name=name, create=True, size=size)
+    except FileExistsError: # left behind by a fetcher that did not shut down cleanly
+        stale = shared_memory.SharedMemory(name=name)
+        stale.close()
+        stale.unlink()
+        return shared_memory.SharedMemory(name=name, create=True, size=size)
+
+class AttachedSharedMemory(shared_memory.SharedMemory):
+    def __del__(self):
+        try:
+            self.close()
+        except BufferError:
+            pass # numpy views still alive (interpreter exit); the mapping goes with the process
+
+
+def attach_shared_memory(name):
+    if sys.version_info >= (3, 13):
+        return AttachedSharedMemory(name=name, track=False)
+    # Before 3.13 merely attaching registers the segment with this process's resource
+    # tracker, which would then unlink it from under the publisher when this process exits
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return AttachedSharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+def pack_shared_table(columns, generation):
+    # -> segment size and a writer(buf); float64 arrays are kept 8-byte aligned
+    parts, layout = [], []
+    offset = 0
+    def place(data):
+        nonlocal offset
+        start = offset
+        parts.append((start, data))
+        offset = -(-(offset + len(data)) // 8) * 8
+        return start
+    for name, values in columns.items():
+        if values.dtype == object:
+            encoded = [str(value).encode('utf-8') for value in values]
+            ends = np.cumsum([0] + [len(value) for value in encoded], dtype='<i8')
+            layout.append([name, 'str', place(memoryview(ends).cast('B')), place(b''.join(encoded)), len(values)])
+        else:
+            data = np.ascontiguousarray(values, dtype='<f8')
+            layout.append([name, 'f8', place(memoryview(data).cast('B')), 0, len(data)])
+    encoded_layout = json.dumps(layout, ensure_ascii=False).encode('utf-8')
+    base = -(-(SHARED_HEADER.itemsize + len(encoded_layout)) // 8) * 8
+
+    def write(buf):
+        header = np.ndarray(1, dtype=SHARED_HEADER, buffer=buf)
+        header['generation'], header['layout_size'] = generation, len(encoded_layout)
+        del header
+        buf[SHARED_HEADER.itemsize:SHARED_HEADER.itemsize + len(encoded_layout)] = encoded_layout
+        for start, data in parts:
+            buf[base + start:base + start + len(data)] = data
+    return max(base + offset, 1), write
+
+def unpack_shared_table(buf, generation):
+    header = np.ndarray(1, dtype=SHARED_HEADER, buffer=buf)
+    found, layout_size = int(header['generation'][0]), int(header['layout_size'][0])
+    del header
+    if found != generation: # a segment name reused after a publisher restart
+        raise ValueError(f"shared segment holds generation {found}, expected {generation}")
+    layout = json.loads(bytes(buf[SHARED_HEADER.itemsize:SHARED_HEADER.itemsize + layout_size]))
+    base = -(-(SHARED_HEADER.itemsize + layout_size) // 8) * 8
+    columns = {}
+    for name, kind, start, blob_start, rows in layout:
+        if kind == 'str':
+            ends = np.frombuffer(buf, dtype='<i8', count=rows + 1, offset=base + start).tolist()
+            blob = bytes(buf[base + blob_start:base + blob_start + ends[-1]])
+            values = np.empty(rows, dtype=object)
+            values[:] = [blob[a:b].decode('utf-8') for a, b in zip(ends[:-1], ends[1:])]
+        else:
+            values = np.frombuffer(buf, dtype='<f8', count=rows, offset=base + start) # zero-copy
+            values.flags.writeable = False
+        columns[name] = values
+    return columns
 
-                for (const id in fields) {
-                    const el = document.getElementById(id);
-                    if (el) el.innerText = fields[id] !== null && fields[id] !== undefined ? fields[id] : '--';
-                }
-                const luEl = document.getElementById('lastUpdated');
-                if (luEl) luEl.innerText = new Date().toLocaleTimeString();
 
-            } catch (error) {
-                console.error('Realtime data error:', error);
-                displayError('realtimeError', '获取实时数据失败: ' + error.message);
-            } finally {
-                refreshBtn.disabled = false; // 无论成功失败都恢复按钮
-                refreshBtn.innerText = '手动刷新';
-            }
-        }
+class SharedTablePublisher:
+    def __init__(self, prefix, channel):
+        self.name = f"{prefix}.{channel}"
+        self.control = create_shared_memory(self.name, SHARED_CONTROL_DTYPE.itemsize)
+        self.state = np.ndarray(1, dtype=SHARED_CONTROL_DTYPE, buffer=self.control.buf)
+        self.state[0] = (0, 0, 0.0)
+        self.generation = 0
+        self._segments = [] # linked generations, oldest first
+        self._lock = threading.Lock()
 
-        // 新增手动刷新函数
-        function manualRefreshData() {
-            if (currentStockCode) {
-                fetchRealtimeData(currentStockCode);
-            } else {
-                displayError('realtimeError', '请先检索一只股票。');
-            }
-        }
+    def publish(self, columns, fetched_at):
+        with self._lock:
+            generation = self.generation + 1
+            size, write = pack_shared_table(columns, generation)
+            segment = create_shared_memory(f"{self.name}.{generation}", size)
+            write(segment.buf)
+            seq = int(self.state['seq'][0])
+            self.state['seq'] = seq + 1 # odd: readers retry
+            self.state['generation'] = generation
+            self.state['fetched_at'] = fetched_at
+            self.state['seq'] = seq + 2
+            self.generation = generation
+            self._segments.append(segment)
+            while len(self._segments) > SHARED_KEEP_GENERATIONS:
+                # Unlinking only removes the name; workers still mapping it keep their views
+                old = self._segments.pop(0)
+                old.close()
+                old.unlink()
 
-        async function fetchAndDrawKLine(stockCode) {
-            if (!stockCode || !klineChartInstance) return;
-            clearError('klineError');
-            klineChartInstance.showLoading();
-            try {
-                const response = await fetch(`/api/history?code=${stockCode}`);
-                if (!response.ok) {
-                    const errData = await response.json().catch(() => ({error: "获取历史数据失败。"}));
-                    throw new Error(errData.error || `服务器错误: ${response.status}`);
-                }
-                const data = await response.json();
+    def close(self):
+        with self._lock:
+            for segment in self._segments:
+                segment.close()
+                segment.unlink()
+            self._segments = []
+            del self.state
+            self.control.close()
+            self.control.unlink()
 
-                if (data.error) {
-                    displayError('klineError', data.error);
-                    klineChartInstance.hideLoading();
-                    return;
-                }
-                
-                const dates = data.map(item => item.date);
-                const klineData = data.map(item => [item.open, item.close, item.low, item.high]);
-                const volumes = data.map((item, idx) => [idx, item.volume, item.open > item.close ? -1 : 1]);
 
+class SharedTableReader:
+    def __init__(self, prefix, channel):
+        self.name = f"{prefix}.{channel}"
+        self.control = None
+        self.state = None
+        self._attached = [] # segments whose arrays may still be referenced by a snapshot
 
-                const option = {
-                    tooltip: {
-                        trigger: 'axis',
-                        axisPointer: { type: 'cross' }
-                    },
-                    legend: { data: ['日K', '成交量'] },
-                    grid: [
-                        { left: '10%', right: '8%', height: '50%' },
-                        { left: '10%', right: '8%', top: '65%', height: '16%' }
-                    ],
-                    xAxis: [
-                        { type: 'category', data: dates, scale: true, boundaryGap: false, axisLine: { onZero: false }, splitLine: { show: false }, min: 'dataMin', max: 'dataMax' },
-                        { type: 'category', gridIndex: 1, data: dates, scale: true, boundaryGap: false, axisLine: { onZero: false }, axisTick: { show: false }, splitLine: { show: false }, axisLabel: { show: false }, min: 'dataMin', max: 'dataMax' }
-                    ],
-                    yAxis: [
-                        { scale: true, splitArea: { show: true }, axisLabel: { formatter: function (value) { return value.toFixed(2); } } },
-                        { scale: true, gridIndex: 1, splitNumber: 2, axisLabel: { show: false }, axisLine: { show: false }, axisTick: { show: false }, splitLine: { show: false } }
-                    ],
-                    dataZoom: [
-                        { type: 'inside', xAxisIndex: [0, 1], start: 70, end: 100 },
-                        { show: true, xAxisIndex: [0, 1], type: 'slider', top: '85%', start: 70, end: 100 }
-                    ],
-                    series: [
-                        {
-                            name: '日K',
-                            type: 'candlestick',
-                            data: klineData,
-                            itemStyle: {
-                                color: '#FD1050', // 阳线 red
-                                color0: '#0CF49B', // 阴线 green
-                                borderColor: '#FD1050',
-                                borderColor0: '#0CF49B'
-                            }
-                        },
-                        {
-                            name: '成交量',
-                            type: 'bar',
-                            xAxisIndex: 1,
-                            yAxisIndex: 1,
-                            data: volumes.map(item => ({
-                                value: item[1],
-                                itemStyle: {
-                                    color: item[2] === 1 ? '#FD1050' : '#0CF49B' // 阳红柱，阴绿柱
-                                }
-                            }))
-                        }
-                    ]
-                };
-                klineChartInstance.hideLoading();
-                klineChartInstance.setOption(option);
-            } catch (error) {
-                console.error('K-line data error:', error);
-                displayError('klineError', '获取K线数据失败: ' + error.message);
-                if (klineChartInstance) klineChartInstance.hideLoading();
-            }
-        }
-        
-        window.onload = () => {
-            initKlineChart();
-            document.getElementById('manualRefreshBtn').disabled = true; // 初始禁用刷新按钮
-        }
-    </script>
-</body>
-</html>
-"""
+    def poll(self):
+        # -> (generation, fetched_at) of the latest publication, or None before the first one
+        if self.control is None:
+            try:
+                self.control = attach_shared_memory(self.name)
+            except FileNotFoundError:
+                return None
+            self.state = np.ndarray(1, dtype=SHARED_CONTROL_DTYPE, buffer=self.control.buf)
+        for _ in range(1000):
+            seq = int(self.state['seq'][0])
+            if seq % 2 == 0:
+                generation, fetched_at = int(self.state['generation'][0]), float(self.state['fetched_at'][0])
+                if int(self.state['seq'][0]) == seq:
+                    return (generation, fetched_at) if generation else None
+            time.sleep(0)
+        return None
 
-stock_list_df = None
+    def attach(self, generation):
+        segment = attach_shared_memory(f"{self.name}.{generation}")
+        try:
+            columns = unpack_shared_table(segment.buf, generation)
+        except Exception:
+            segment.close()
+            raise
+        # close() refuses (BufferError) while numpy views of a segment are alive, so older
+        # segments are released once the snapshots built on them have been dropped
+        still_used = []
+        for old in self._attached:
+            try:
+                old.close()
+            except BufferError:
+                still_used.append(old)
+        self._attached = still_used + [segment]
+        return columns
 
-def get_stock_list_cached():
-    global stock_list_df
-    if stock_list_df is None or stock_list_df.empty: # Check if empty too
+
+def run_shared_publisher(prefix):
+    # Body of the fetcher process: the usual background refreshers, with every new snapshot
+    # and symbol-list change published for the workers
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    spot = SharedTablePublisher(prefix, 'spot')
+    symbols = SharedTablePublisher(prefix, 'symbols')
+    def publish_snapshot(previous, snapshot):
+        spot.publish(snapshot.columns, snapshot.fetched_at)
+    spot_cache.subscribe(publish_snapshot)
+    published = None
+    try:
+        get_stock_list_cached()
+        start_snapshot_refresher()
+        print(f"Publishing market snapshots to shared memory '{prefix}' (pid {os.getpid()}).")
+        while not stop_event.is_set():
+            df = stock_list_df
+            if df is not None and df is not published:
+                symbols.publish({column: df[column].astype(str).to_numpy(dtype=object) for column in ('代码', '名称')},
+                                stock_list_fetched_at or time.time())
+                published = df
+            stop_event.wait(SHARED_POLL_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        spot.close()
+        symbols.close()
+
+
+class SharedSnapshotFollower(threading.Thread):
+    # Worker side: swaps each newly published generation into spot_cache and the symbol list.
+    # spot_cache listeners (SSE push, search index) run exactly as after a local fetch.
+    def __init__(self, prefix):
+        super().__init__(name='shared-snapshot-follower', daemon=True)
+        self.spot = SharedTableReader(prefix, 'spot')
+        self.symbols = SharedTableReader(prefix, 'symbols')
+        self.generations = {'spot': 0, 'symbols': 0}
+        self._stop_event = threading.Event()
+
+    def sync(self):
+        published = self.symbols.poll()
+        if published and published[0] != self.generations['symbols']:
+            columns = self.symbols.attach(published[0])
+            update_stock_list(pd.DataFrame(columns, dtype=str), published[1], persist=False)
+            self.generations['symbols'] = published[0]
+        published = self.spot.poll()
+        if published and published[0] != self.generations['spot']:
+            columns = self.spot.attach(published[0])
+            spot_cache.swap(SpotSnapshot.from_columns(columns, published[1], previous=spot_cache.current()))
+            self.generations['spot'] = published[0]
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.sync()
+            except Exception as e:
+                print(f"Error reading shared snapshot: {e}")
+            self._stop_event.wait(SHARED_POLL_INTERVAL)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+shared_follower = None
+
+def start_shared_follower(prefix=None):
+    global shared_follower
+    if shared_follower is None:
+        spot_cache.background = True # never fetch upstream from a worker
+        shared_follower = SharedSnapshotFollower(prefix or SHARED_SNAPSHOT)
+        shared_follower.start()
+    return shared_follower
+
+
+# --- Realtime push (Server-Sent Events) ---
+# Clients subscribe to a set of codes. On every snapshot swap the broadcaster converts the
+# quotes of all subscribed codes once, diffs them against what was last sent, and pushes only
+# the changed fields to the subscribers of the changed codes. One upstream fetch therefore
+# serves every connected browser.
+STREAM_HEARTBEAT = 15 # 秒，无数据时发送注释行保持连接
+STREAM_QUEUE_SIZE = 100 # 积压超过此数量的慢客户端会被断开，浏览器重连后重新获得完整快照
+STREAM_FIELDS = [field for field in QUOTE_FIELDS if field not in ('code', 'name')]
+
+def format_sse(event, data):
+    return b"event: " + event.encode() + b"\ndata: " + dumps_json(data) + b"\n\n"
+
+
+class QueueSubscription:
+    # For the threaded server: a blocking queue drained by the response generator
+    def __init__(self, codes):
+        self.codes = codes
+        self.closed = False
+        self.events = queue.Queue(STREAM_QUEUE_SIZE)
+
+    def push(self, event):
         try:
-            print("Fetching A-share list from akshare (stock_zh_a_spot_em)...")
-            # Fetch all A-share stock codes and names from Eastmoney real-time data
-            # This df contains code, name, and other real-time fields
-            temp_df = ak.stock_zh_a_spot_em()
-            if temp_df is not None and not temp_df.empty:
-                stock_list_df = temp_df[['代码', '名称']].copy() # Keep only relevant columns
-                print(f"Successfully fetched {len(stock_list_df)} A-share stock entries.")
-            else:
-                print("Failed to fetch stock list or list is empty, will try generic search.")
-                stock_list_df = pd.DataFrame(columns=['代码', '名称']) # Ensure it's a DataFrame
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.closed = True
+
+    def next_event(self, timeout):
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class LoopSubscription:
+    # For the ASGI server: events are handed to the event loop that owns the connection
+    def __init__(self, codes, loop):
+        self.codes = codes
+        self.closed = False
+        self.loop = loop
+        self.events = asyncio.Queue()
+
+    def push(self, event):
+        self.loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event):
+        if self.events.qsize() >= STREAM_QUEUE_SIZE:
+            self.closed = True
+        else:
+            self.events.put_nowait(event)
+
+    async def next_event(self, timeout):
+        try:
+            return await asyncio.wait_for(self.events.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class QuoteBroadcaster:
+    def __init__(self, cache):
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._subscribers = {} # code -> set of subscriptions
+        self._last_sent = {} # code -> last quote pushed for it
+
+    def add(self, subscription):
+        with self._lock:
+            for code in subscription.codes:
+                self._subscribers.setdefault(code, set()).add(subscription)
+        snapshot = self.cache.current()
+        if snapshot is not None:
+            rows, missing = snapshot.locate(subscription.codes)
+            quotes = {quote.pop('code'): quote for quote in quote_records(rows, ['code', 'name'] + STREAM_FIELDS)}
+            with self._lock:
+                # A code nobody was watching has no baseline yet: diff the next publish against
+                # what this subscriber was just sent, so the first delta carries only changes
+                for code, quote in quotes.items():
+                    if code not in self._last_sent:
+                        self._last_sent[code] = {field: quote[field] for field in STREAM_FIELDS}
+            subscription.push(('snapshot', {
+                "snapshot_time": datetime.fromtimestamp(snapshot.fetched_at).isoformat(),
+                "quotes": quotes,
+                "missing": missing,
+            }))
+
+    def remove(self, subscription):
+        with self._lock:
+            for code in subscription.codes:
+                subscribers = self._subscribers.get(code)
+                if subscribers is None:
+                    continue
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[code]
+                    self._last_sent.pop(code, None)
+
+    def publish(self, previous, snapshot):
+        with self._lock:
+            codes = list(self._subscribers)
+        if not codes:
+            return
+        rows, _ = snapshot.locate(codes)
+        changed = {}
+        for quote in quote_records(rows, ['code'] + STREAM_FIELDS):
+            code = quote.pop('code')
+            last = self._last_sent.get(code)
+            delta = quote if last is None else {field: value for field, value in quote.items() if last.get(field) != value}
+            if delta:
+                changed[code] = delta
+            self._last_sent[code] = quote
+        if not changed:
+            return
+        with self._lock:
+            targets = {subscription for code in changed for subscription in self._subscribers.get(code, ())}
+        snapshot_time = datetime.fromtimestamp(snapshot.fetched_at).isoformat()
+        for subscription in targets:
+            quotes = {code: changed[code] for code in subscription.codes if code in changed}
+            try:
+                subscription.push(('delta', {"snapshot_time": snapshot_time, "quotes": quotes}))
+            except RuntimeError: # the connection's event loop is already gone
+                subscription.closed = True
+
+    def subscriber_count(self):
+        with self._lock:
+            return len({subscription for subscribers in self._subscribers.values() for subscription in subscribers})
+
+
+quote_broadcaster = QuoteBroadcaster(spot_cache)
+spot_cache.subscribe(quote_broadcaster.publish)
+
+
+# --- Intraday minute bars ---
+# Minute bars for subscribed symbols (every watchlist code, plus any code requested from
+# /api/intraday) are built from successive spot snapshots: each bar opens at the first price
+# seen in its minute, tracks high/low/close, and takes its volume from the growth of the
+# snapshot's cumulative 成交量. All symbols live in one (symbols x INTRADAY_CAPACITY) block of
+# per-symbol ring buffers, updated with a handful of vectorized writes per snapshot. After the
+# close the session is written to data/intraday/<date>/<code>.npy and a new block is started
+# at the next open, so slices handed out earlier stay valid. A code subscribed by a request
+# is dropped once nobody has read it for INTRADAY_EXPIRY seconds; watchlist codes stay.
+# Single-process only: with a shared snapshot (--workers N) every worker would build its own
+# partial book and they would all flush the same files, so the current session is not served.
+INTRADAY_DIR = os.path.join(DATA_DIR, 'intraday')
+INTRADAY_CAPACITY = int(os.environ.get('STOCKAI_INTRADAY_CAPACITY', '256')) # 每只股票保留的分钟K线数，一个交易日 240 根
+INTRADAY_MAX_SYMBOLS = int(os.environ.get('STOCKAI_INTRADAY_MAX_SYMBOLS', '500'))
+INTRADAY_EXPIRY = float(os.environ.get('STOCKAI_INTRADAY_EXPIRY', '1800')) # 秒，无人读取的请求订阅过期时间
+INTRADAY_PERIODS = (1, 5, 15) # 分钟
+# (snapshots from, until, first bar, last bar). Bars are labelled by the minute they end in,
+# like 通达信: the opening auction goes into 09:31, the closing auction into 15:00.
+INTRADAY_SESSIONS = ((dtime(9, 25), dtime(11, 31), dtime(9, 31), dtime(11, 30)),
+                     (dtime(13, 0), dtime(15, 1), dtime(13, 1), dtime(15, 0)))
+MINUTE_DTYPE = np.dtype([('date', 'datetime64[m]')] + KLINE_DTYPE.descr[1:])
+
+def minute_label(now):
+    # The bar a snapshot taken at `now` belongs to, or None outside continuous trading
+    if not trading_calendar.is_trading_day(now.date()):
+        return None
+    for since, until, first, last in INTRADAY_SESSIONS:
+        if since <= now.time() < until:
+            label = (now.replace(second=0, microsecond=0) + timedelta(minutes=1)).time()
+            return np.datetime64(datetime.combine(now.date(), min(max(label, first), last)), 'm')
+    return None
+
+def volumes_moved(previous, snapshot):
+    if previous.symbols is not snapshot.symbols:
+        return True
+    return not np.array_equal(previous.columns['成交量'], snapshot.columns['成交量'], equal_nan=True)
+
+def rollup_minutes(bars, period):
+    if period == 1 or len(bars) == 0:
+        return bars
+    day = bars['date'][0].astype('datetime64[D]')
+    keys = ((bars['date'] - day).astype('int64') - 1) // period # 09:31-09:35 -> one 5-minute bar
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    out = aggregate_bars(bars, starts)
+    out['date'] = day + ((keys[starts] + 1) * period).astype('timedelta64[m]') # labelled by the interval's end
+    return out
+
+
+class IntradayBook:
+    def __init__(self, root, capacity):
+        self.root = root
+        self.capacity = capacity
+        self.rows = {} # code -> row of the block
+        self.watched = set() # watchlist codes, never expired
+        self.read_at = {} # code -> last time a request read or subscribed it
+        self._free = [] # rows of expired codes, reused by the next subscription
+        self._next_row = 0
+        self.session = None # date of the bars being built
+        self.flushed = True
+        self._lock = threading.Lock()
+        self._allocate(64)
+
+    def _allocate(self, size):
+        self.bars = np.zeros((size, self.capacity), dtype=MINUTE_DTYPE)
+        self.count = np.zeros(size, dtype='int64') # bars ever appended; > capacity once wrapped
+        self.last_volume = np.full(size, np.nan) # cumulative volume at the previous snapshot
+        self.base_volume = np.full(size, np.nan) # cumulative volume when the current bar opened
+
+    def subscribe(self, codes):
+        # For requests: returns False when the symbol limit leaves some of `codes` unsubscribed
+        with self._lock:
+            now = time.time()
+            self.read_at.update((code, now) for code in codes)
+            return self._subscribe(codes)
+
+    def _subscribe(self, codes):
+        for code in codes:
+            if code in self.rows:
+                continue
+            if len(self.rows) >= INTRADAY_MAX_SYMBOLS:
+                self._expire()
+                if len(self.rows) >= INTRADAY_MAX_SYMBOLS:
+                    return False
+            if self._free:
+                row = self._free.pop()
+                self.count[row] = 0
+                self.last_volume[row] = self.base_volume[row] = np.nan
+                self.rows[code] = row
+                continue
+            if self._next_row == len(self.count):
+                bars, count = self.bars, self.count
+                last_volume, base_volume = self.last_volume, self.base_volume
+                self._allocate(2 * len(count))
+                self.bars[:len(count)] = bars
+                self.count[:len(count)] = count
+                self.last_volume[:len(count)] = last_volume
+                self.base_volume[:len(count)] = base_volume
+            self.rows[code] = self._next_row
+            self._next_row += 1
+        return True
+
+    def _expire(self):
+        cutoff = time.time() - INTRADAY_EXPIRY
+        for code in [code for code in self.rows if code not in self.watched and self.read_at.get(code, 0) < cutoff]:
+            self._free.append(self.rows.pop(code))
+            self.read_at.pop(code, None)
+
+    def on_snapshot(self, previous, snapshot):
+        now = datetime.fromtimestamp(snapshot.fetched_at, tz=MARKET_TZ)
+        label = minute_label(now)
+        try:
+            watched = [code for codes in load_watchlists().values() for code in codes]
         except Exception as e:
-            print(f"Error fetching stock list with stock_zh_a_spot_em: {e}. Falling back to empty list.")
-            stock_list_df = pd.DataFrame(columns=['代码', '名称']) # Ensure it's a DataFrame on error
-    return stock_list_df
+            print(f"Intraday: cannot read watchlists: {e}")
+            watched = []
+        with self._lock:
+            self.watched = set(watched)
+            self._subscribe(watched)
+            self._expire()
+            if not self.flushed and (now.date() != self.session or now.time() >= INTRADAY_SESSIONS[-1][1]):
+                self.flush()
+            if label is None or not self.rows:
+                return
+            if now.date() != self.session:
+                # Only once volumes move: a day missing from the calendar still serves the last
+                # session's frozen table, whose cumulative volumes would land in the opening bar
+                if previous is None or not volumes_moved(previous, snapshot):
+                    return
+                # New session: a fresh block, so slices of the old one held by requests stay valid
+                self._allocate(len(self.count))
+                self.session = now.date()
+                self.flushed = False
+            self._ingest(label, snapshot)
+
+    def _ingest(self, label, snapshot):
+        codes = list(self.rows)
+        rows = np.fromiter(self.rows.values(), dtype='int64', count=len(codes))
+        positions = snapshot.frame.index.get_indexer(codes)
+        rows, positions = rows[positions >= 0], positions[positions >= 0]
+        price = snapshot.columns['最新价'][positions]
+        volume = snapshot.columns['成交量'][positions]
+        trading = price > 0 # NaN (停牌) compares False
+        rows, price, volume = rows[trading], price[trading], volume[trading]
+
+        bars = self.bars
+        count = self.count[rows]
+        slot = (count - 1) % self.capacity
+        same = (count > 0) & (bars['date'][rows, slot] == label)
+
+        # Still the same minute: extend the forming bar
+        r, s, p = rows[same], slot[same], price[same]
+        bars['high'][r, s] = np.fmax(bars['high'][r, s], p)
+        bars['low'][r, s] = np.fmin(bars['low'][r, s], p)
+        bars['close'][r, s] = p
+        bars['volume'][r, s] = np.fmax(volume[same] - self.base_volume[r], 0)
+
+        # A new minute: open a bar. Its volume counts from the previous snapshot; a symbol seen
+        # for the first time starts from zero at the open, or from now when picked up mid-session.
+        new = ~same
+        r, s, p = rows[new], count[new] % self.capacity, price[new]
+        opening = label == np.datetime64(datetime.combine(self.session, INTRADAY_SESSIONS[0][2]), 'm')
+        previous = self.last_volume[r]
+        self.base_volume[r] = np.where(np.isnan(previous), 0 if opening else volume[new], previous)
+        bars['date'][r, s] = label
+        for field in ('open', 'high', 'low', 'close'):
+            bars[field][r, s] = p
+        bars['volume'][r, s] = np.fmax(volume[new] - self.base_volume[r], 0)
+        self.count[r] += 1 # last, so readers never see a bar before it is written
+
+        self.last_volume[rows] = volume
+
+    def window(self, code):
+        # The session's bars for `code` in time order: a view into the block unless the ring
+        # has wrapped (INTRADAY_CAPACITY below a full session). None if not subscribed.
+        with self._lock:
+            row = self.rows.get(code)
+            if row is None:
+                return None
+            self.read_at[code] = time.time()
+            return self._window(row)
+
+    def _window(self, row):
+        bars, count = self.bars[row], int(self.count[row])
+        if count <= self.capacity:
+            return bars[:count]
+        head = count % self.capacity
+        return np.concatenate([bars[head:], bars[:head]])
+
+    def path(self, code, day):
+        return os.path.join(self.root, str(day), f"{code}.npy")
+
+    def load(self, code, day):
+        try:
+            return np.load(self.path(code, day), mmap_mode='r')
+        except FileNotFoundError:
+            return None
+
+    def flush(self):
+        # Called with the lock held, once the session is over
+        written = 0
+        for code, row in self.rows.items():
+            bars = self._window(row)
+            if len(bars) == 0:
+                continue
+            path = self.path(code, self.session)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                np.save(f, bars)
+            os.replace(tmp_path, path)
+            written += 1
+        self.flushed = True
+        print(f"Intraday: saved {self.session} minute bars of {written} symbols to {self.root}")
+
+    def symbol_count(self):
+        return len(self.rows)
+
+
+intraday_book = IntradayBook(INTRADAY_DIR, INTRADAY_CAPACITY)
+if not SHARED_SNAPSHOT:
+    spot_cache.subscribe(intraday_book.on_snapshot)
+
+
+# --- Request instrumentation ---
+def route_label():
+    # The URL rule, not the raw path, so label cardinality stays bounded
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+@app.before_request
+def start_request_trace():
+    _trace_local.stages = {}
+    _trace_local.started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    stages = getattr(_trace_local, 'stages', None) or {}
+    elapsed = time.perf_counter() - getattr(_trace_local, 'started', time.perf_counter())
+    route = route_label()
+    REQUEST_LATENCY.observe(route, request.method, str(response.status_code), value=elapsed)
+    if not response.is_streamed:
+        RESPONSE_SIZE.observe(route, value=response.calculate_content_length() or 0)
+    for name, seconds in stages.items():
+        STAGE_LATENCY.observe(route, name, value=seconds)
+    if TRACE_ALL_REQUESTS or request.args.get('trace') == '1':
+        timings = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in stages.items()]
+        response.headers['Server-Timing'] = ', '.join(timings + [f"total;dur={elapsed * 1000:.1f}"])
+    return response
+
+@app.teardown_request
+def end_request_trace(exc):
+    _trace_local.stages = None
+
+def cache_stats():
+    stats = {}
+    for cache, counts in (('spot_snapshot', spot_cache.stats), ('kline_store', kline_store.stats),
+                          ('kline_adjusted', kline_store.adjust_stats), ('indicators', indicator_cache.stats),
+                          ('compressed', compressed_cache.stats)):
+        stats.update({(cache, result): count for result, count in counts.items()})
+    return stats
+
+def snapshot_gauge(value):
+    def collect():
+        snapshot = spot_cache.current()
+        return {} if snapshot is None else {(): value(snapshot)}
+    return collect
+
+BREAKER_STATES = {'closed': 0, 'half_open': 0.5, 'open': 1}
+
+MetricCallback('stockai_cache_requests_total', 'Cache lookups by cache and outcome.', ('cache', 'result'), cache_stats, kind='counter')
+MetricCallback('stockai_spot_snapshot_age_seconds', 'Age of the spot snapshot being served.', (), snapshot_gauge(lambda snapshot: snapshot.age()))
+MetricCallback('stockai_spot_snapshot_rows', 'Stocks in the spot snapshot being served.', (), snapshot_gauge(lambda snapshot: len(snapshot.frame)))
+MetricCallback('stockai_circuit_breaker_state', 'Upstream circuit breaker: 0 closed, 0.5 half-open, 1 open.', ('function',),
+               lambda: {(endpoint,): BREAKER_STATES[breaker.state] for endpoint, breaker in list(upstream.breakers.items())})
+MetricCallback('stockai_stream_subscribers', 'Open /api/stream connections.', (), lambda: {(): quote_broadcaster.subscriber_count()})
+MetricCallback('stockai_intraday_symbols', 'Symbols whose minute bars are being built.', (), lambda: {(): intraday_book.symbol_count()})
+
+
+# --- HTTP caching and compression ---
+# Daily-bar responses carry a strong ETag derived from exactly what they contain (route, symbol,
+# adjustment, the bars themselves - so the last bar's date and any intraday revision or
+# 除权 rewrite - and the query parameters), so a repeat view is answered with 304 before
+# anything is serialized. Cache-Control follows the session: short while bars can still
+# change, until the next open once the close has settled. Large bodies are compressed
+# (brotli when the optional package is installed, else gzip); compressed bodies of
+# ETag-bearing responses are kept in a byte-bounded LRU, so hot symbols skip serialization
+# and compression entirely. Each encoding gets its own ETag suffix, as RFC 9110 requires.
+COMPRESS_MIN_SIZE = 1024 # 字节
+COMPRESSIBLE_TYPES = ('application/json', 'text/html', 'text/plain')
+COMPRESSED_CACHE_BYTES = int(float(os.environ.get('STOCKAI_COMPRESSED_CACHE_MB', '64')) * 2 ** 20)
+KLINE_SETTLE_SECONDS = 1800 # after the close, daily bars may still be corrected for a while
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+def daily_cache_control(now=None):
+    now = now or market_now()
+    close = datetime.combine(now.date(), TRADING_SESSIONS[-1][1], tzinfo=MARKET_TZ)
+    settling = trading_calendar.is_trading_day(now.date()) and close <= now < close + timedelta(seconds=KLINE_SETTLE_SECONDS)
+    if in_trading_session(now) or settling:
+        return f"public, max-age={int(KLINE_RECHECK_INTERVAL)}"
+    return f"public, max-age={int(seconds_until_next_session(now))}"
+
+def bars_etag(code, adjust, bars, args):
+    digest = hashlib.blake2b(digest_size=16)
+    params = sorted((name, value) for name, value in args.items(multi=True) if name != 'trace')
+    digest.update(f"{request.path}|{code}|{adjust}|{params}".encode('utf-8'))
+    digest.update(np.ascontiguousarray(bars).tobytes())
+    return digest.hexdigest()
+
+def accepted_encoding():
+    if brotli is not None and request.accept_encodings['br']:
+        return 'br'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+def compress_body(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
 
+class CompressedCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict() # (etag, encoding) -> (body, headers)
+        self._lock = threading.Lock()
+        self.stats = {'hit': 0, 'miss': 0}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['miss'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hit'] += 1
+            return entry
+
+    def put(self, key, body, headers):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self._entries[key] = (body, headers)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+compressed_cache = CompressedCache(COMPRESSED_CACHE_BYTES)
+
+def cached_response(etag, last_modified=None, cache_control=None):
+    # Called before the body is built: 304 when the client's copy is current, or the stored
+    # compressed body for this ETag. None means the route has to render it.
+    headers = {'Cache-Control': cache_control} if cache_control else {}
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+    variants = [etag, f"{etag}-gzip", f"{etag}-br"]
+    if request.if_none_match:
+        not_modified = any(request.if_none_match.contains(variant) for variant in variants)
+    else:
+        not_modified = last_modified is not None and request.if_modified_since is not None \
+            and last_modified.replace(microsecond=0) <= request.if_modified_since
+    if not_modified:
+        response = app.response_class(status=304, headers=headers)
+        response.set_etag(etag)
+        return response
+    encoding = accepted_encoding()
+    entry = compressed_cache.get((etag, encoding)) if encoding else None
+    if entry is None:
+        return None
+    body, stored_headers = entry
+    response = app.response_class(body, mimetype='application/json', headers={**stored_headers, **headers})
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag(f"{etag}-{encoding}")
+    return response
+
+def mark_cacheable(response, etag, last_modified=None, cache_control=None):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    if cache_control:
+        response.headers['Cache-Control'] = cache_control
+    return response
+
+@app.after_request
+def compress_response(response):
+    # Registered after record_request_metrics, so it runs first and sizes are post-compression
+    if response.is_streamed or response.status_code != 200 or 'Content-Encoding' in response.headers \
+            or response.mimetype not in COMPRESSIBLE_TYPES:
+        return response
+    encoding = accepted_encoding()
+    if encoding is None or response.calculate_content_length() < COMPRESS_MIN_SIZE:
+        return response
+    with stage('compress'):
+        body = compress_body(response.get_data(), encoding)
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        kept = {name: value for name, value in response.headers.items()
+                if name not in ('Content-Type', 'Content-Length', 'ETag', 'Cache-Control', 'Last-Modified', 'Server-Timing')}
+        compressed_cache.put((etag, encoding), body, kept)
+        response.set_etag(f"{etag}-{encoding}")
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return app.response_class(render_metrics(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/')
 def index():
@@ -342,34 +3166,26 @@ def search_stock_api():
     if not query:
         return jsonify({"error": "查询不能为空"}), 400
 
-    all_a_shares = get_stock_list_cached()
-    
-    matched_stock = None
+    try:
+        limit = min(max(int(request.args.get('limit', SEARCH_DEFAULT_LIMIT)), 1), SEARCH_MAX_LIMIT)
+    except ValueError:
+        return jsonify({"error": "limit 必须是整数"}), 400
 
-    # Try to match by code first (6 digits) from cached list
-    if query.isdigit() and len(query) == 6:
-        if not all_a_shares.empty:
-            stock_data = all_a_shares[all_a_shares['代码'] == query]
-            if not stock_data.empty:
-                matched_stock = {"code": stock_data.iloc[0]['代码'], "name": stock_data.iloc[0]['名称']}
-        
-    # If not matched by code from cache, or query is not a code, try to match by name from cache
-    if not matched_stock and not query.isdigit(): 
-        if not all_a_shares.empty:
-            exact_name_match = all_a_shares[all_a_shares['名称'].str.lower() == query.lower()]
-            if not exact_name_match.empty:
-                 matched_stock = {"code": exact_name_match.iloc[0]['代码'], "name": exact_name_match.iloc[0]['名称']}
-            else:
-                partial_name_match = all_a_shares[all_a_shares['名称'].str.contains(query, case=False, na=False)]
-                if not partial_name_match.empty:
-                    matched_stock = {"code": partial_name_match.iloc[0]['代码'], "name": partial_name_match.iloc[0]['名称']}
+    with stage('search'):
+        index = get_search_index()
+        candidates = index.search(query, limit)
+
+    matched_stock = None
+    if candidates:
+        matched_stock = {"code": candidates[0]['code'], "name": candidates[0]['name']}
 
-    # If still not matched, try fallback search using ak.stock_fuzzy_search
-    if not matched_stock:
+    # The index answers from memory. Only when no A-share list could be loaded at all,
+    # fall back to the network search below.
+    if not matched_stock and index.empty:
         try:
-            print(f"'{query}' not in cached A-share list or cache is empty, trying ak.stock_fuzzy_search...")
+            print(f"A-share list is empty, trying ak.stock_fuzzy_search for '{query}'...")
             # 使用 ak.stock_fuzzy_search 作为备用方案
-            search_results_df = ak.stock_fuzzy_search(keyword=query)
+            search_results_df = upstream.call('stock_fuzzy_search', keyword=query)
             if not search_results_df.empty:
                 potential_matches = pd.DataFrame()
                 # 筛选 A 股市场 (通常类型包含 A股/股票，市场包含 SH/SZ/BJ)
@@ -422,7 +3238,7 @@ def search_stock_api():
             # 此处不直接返回错误，允许后续的错误处理
 
     if matched_stock:
-         return jsonify(matched_stock)
+         return jsonify({**matched_stock, "candidates": candidates or [dict(matched_stock, match='fuzzy_search')]})
     else:
         return jsonify({"error": f"未能找到与 '{query}' 匹配的A股股票。请确保输入正确的6位A股代码或中文名称，或稍后再试。"}), 404
 
@@ -434,43 +3250,157 @@ def realtime_stock_data():
         return jsonify({"error": "无效的股票代码格式"}), 400
 
     try:
-        stock_zh_a_spot_em_df = ak.stock_zh_a_spot_em() #东财实时行情
-        stock_data = stock_zh_a_spot_em_df[stock_zh_a_spot_em_df['代码'] == stock_code]
+        with stage('snapshot'):
+            snapshot = spot_cache.get()
+        rows, missing = snapshot.locate([stock_code])
 
-        if stock_data.empty:
+        if missing:
             # Fallback if not in EM list for some reason (e.g. new stock, suspension)
             # Try a more direct real-time quote if available, e.g. stock_individual_info_em
             # For simplicity, we'll stick to stock_zh_a_spot_em for now.
             return jsonify({"error": "未找到该股票的实时数据 (可能已退市或代码错误)"}), 404
 
-        data = stock_data.iloc[0]
-        # Helper to convert to float or None
-        def to_float_or_none(val):
-            try: return float(val) if pd.notna(val) else None
-            except ValueError: return None
-        # Helper to convert to int or None
-        def to_int_or_none(val):
-            try: return int(val) if pd.notna(val) else None
-            except ValueError: return None
-
+        quote = quote_records(rows, QUOTE_FIELDS)[0]
         return jsonify({
-            "code": data['代码'],
-            "name": data['名称'],
-            "price": to_float_or_none(data['最新价']),
-            "change_amount": to_float_or_none(data['涨跌额']),
-            "change_percent": to_float_or_none(data['涨跌幅']),
-            "volume": to_int_or_none(data['成交量']), # 单位：股
-            "turnover": to_float_or_none(data['成交额']), # 单位：元
-            "open": to_float_or_none(data['今开']),
-            "high": to_float_or_none(data['最高']),
-            "low": to_float_or_none(data['最低']),
-            "prev_close": to_float_or_none(data['昨收']),
-            "timestamp": datetime.now().isoformat()
+            **quote,
+            "timestamp": datetime.now().isoformat(),
+            "snapshot_time": datetime.fromtimestamp(snapshot.fetched_at).isoformat(),
+            "snapshot_age": round(snapshot.age(), 3) # 秒
         })
+    except (SnapshotUnavailable, UpstreamUnavailable) as e:
+        return jsonify({"error": str(e)}), 503
+    except UpstreamTimeout as e:
+        print(f"Upstream timeout for {request.path}: {e}")
+        return jsonify({"error": f"数据源响应超时: {str(e)}"}), 504
     except Exception as e:
         print(f"Error fetching realtime data for {stock_code}: {e}")
         return jsonify({"error": f"获取实时数据失败: {str(e)}"}), 500
 
+@app.route('/api/realtime/batch', methods=['GET', 'POST'])
+def realtime_batch_data():
+    # codes / watchlist / fields come from the query string (逗号分隔) or a JSON body
+    params = None
+    if request.method == 'POST' and request.get_data(cache=True):
+        try:
+            params = request.get_json(force=True)
+        except BadRequest:
+            return jsonify({"error": "请求体不是合法的 JSON"}), 400
+    if params is None:
+        params = {}
+    if not isinstance(params, dict):
+        return jsonify({"error": "请求体必须是 JSON 对象，如 {\"codes\": [\"600519\"]}"}), 400
+    for name, types, kind in (('codes', (str, list), '字符串或列表'), ('fields', (str, list), '字符串或列表'),
+                              ('watchlist', str, '字符串')):
+        if params.get(name) is not None and not isinstance(params[name], types):
+            return jsonify({"error": f"{name} 必须是{kind}"}), 400
+
+    def list_param(name):
+        value = params.get(name)
+        if value is None:
+            value = request.args.get(name, '')
+        if isinstance(value, str):
+            value = value.split(',')
+        return [str(item).strip() for item in value if str(item).strip()]
+
+    codes, error, status = resolve_request_codes(list_param('codes'), params.get('watchlist') or request.args.get('watchlist', ''))
+    if error:
+        return jsonify({"error": error}), status
+
+    fields = list_param('fields') or list(QUOTE_FIELDS)
+    unknown = [field for field in fields if field not in QUOTE_FIELDS]
+    if unknown:
+        return jsonify({"error": f"未知字段: {', '.join(unknown)}"}), 400
+    if 'code' not in fields:
+        fields = ['code'] + fields # 始终返回代码，便于前端对应
+
+    try:
+        with stage('snapshot'):
+            snapshot = spot_cache.get()
+        rows, missing = snapshot.locate(codes)
+        return jsonify({
+            "quotes": quote_records(rows, fields),
+            "missing": missing,
+            "timestamp": datetime.now().isoformat(),
+            "snapshot_time": datetime.fromtimestamp(snapshot.fetched_at).isoformat(),
+            "snapshot_age": round(snapshot.age(), 3) # 秒
+        })
+    except (SnapshotUnavailable, UpstreamUnavailable) as e:
+        return jsonify({"error": str(e)}), 503
+    except UpstreamTimeout as e:
+        print(f"Upstream timeout for {request.path}: {e}")
+        return jsonify({"error": f"数据源响应超时: {str(e)}"}), 504
+    except Exception as e:
+        print(f"Error fetching batch realtime data for {len(codes)} codes: {e}")
+        return jsonify({"error": f"获取实时数据失败: {str(e)}"}), 500
+
+@app.route('/api/screener', methods=['GET'])
+def screener_data():
+    where = request.args.get('where', '').strip()
+    sort = request.args.get('sort', '').strip()
+    order = request.args.get('order', 'desc').strip().lower()
+    if order not in ('asc', 'desc'):
+        return jsonify({"error": "order 只能是 asc 或 desc"}), 400
+    try:
+        limit = int(request.args.get('limit', SCREENER_DEFAULT_LIMIT))
+    except ValueError:
+        return jsonify({"error": "limit 必须是整数"}), 400
+    limit = max(1, min(limit, SCREENER_MAX_LIMIT))
+    fields = [field.strip() for field in request.args.get('fields', '').split(',') if field.strip()] or list(QUOTE_FIELDS)
+    unknown = [field for field in fields if field not in SCREENER_FIELDS]
+    if unknown:
+        return jsonify({"error": f"未知字段: {', '.join(unknown)}"}), 400
+    if 'code' not in fields:
+        fields = ['code'] + fields
+
+    try:
+        with stage('snapshot'):
+            snapshot = spot_cache.get()
+        clauses = parse_screener_query(where, snapshot) if where else []
+        sort_column = screener_column(sort, snapshot) if sort else None
+        missing = [field for field in fields if SCREENER_FIELDS[field][0] not in snapshot.columns]
+        if missing:
+            return jsonify({"error": f"行情快照中没有字段: {', '.join(missing)}"}), 400
+        with stage('screen'):
+            positions, matched = screen_snapshot(snapshot, clauses, sort_column, order == 'desc', limit)
+        return jsonify({
+            "quotes": quote_records(snapshot.take(positions), fields, SCREENER_FIELDS),
+            "matched": matched,
+            "total": len(snapshot.frame),
+            "timestamp": datetime.now().isoformat(),
+            "snapshot_time": datetime.fromtimestamp(snapshot.fetched_at).isoformat(),
+            "snapshot_age": round(snapshot.age(), 3) # 秒
+        })
+    except ScreenerError as e:
+        return jsonify({"error": str(e)}), 400
+    except (SnapshotUnavailable, UpstreamUnavailable) as e:
+        return jsonify({"error": str(e)}), 503
+    except UpstreamTimeout as e:
+        print(f"Upstream timeout for {request.path}: {e}")
+        return jsonify({"error": f"数据源响应超时: {str(e)}"}), 504
+    except Exception as e:
+        print(f"Error running screener query '{where}': {e}")
+        return jsonify({"error": f"选股筛选失败: {str(e)}"}), 500
+
+@app.route('/api/stream', methods=['GET'])
+def stream_quotes():
+    # text/event-stream of quote updates; in ASGI mode DashboardASGI.stream serves this path
+    codes, error, status = resolve_request_codes(request.args.get('codes', '').split(','), request.args.get('watchlist', ''))
+    if error:
+        return jsonify({"error": error}), status
+    subscription = QueueSubscription(codes)
+    quote_broadcaster.add(subscription)
+
+    def events():
+        try:
+            while not subscription.closed:
+                event = subscription.next_event(STREAM_HEARTBEAT)
+                yield b": keep-alive\n\n" if event is None else format_sse(*event)
+        finally:
+            quote_broadcaster.remove(subscription)
+
+    return app.response_class(events(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/history', methods=['GET'])
 def history_stock_data():
     stock_code = request.args.get('code', '').strip()
@@ -478,43 +3408,442 @@ def history_stock_data():
         return jsonify({"error": "无效的股票代码格式"}), 400
 
     try:
-        # Fetch daily K-line data, qfq = 前复权
-        # Fetch data for the last 3 years for a reasonable chart size
-        end_date = datetime.now().strftime('%Y%m%d')
-        start_date = (datetime.now() - pd.Timedelta(days=3*365)).strftime('%Y%m%d')
-        
-        stock_hist_df = ak.stock_zh_a_hist(symbol=stock_code, period="daily", start_date=start_date, end_date=end_date, adjust="qfq") 
-        
-        if stock_hist_df.empty:
+        # Daily K-line data, adjust: qfq = 前复权 (default), hfq = 后复权, none = 不复权
+        # Default to the last 3 years for a reasonable chart size; only bars newer than the
+        # local store are fetched from akshare
+        today = market_now().date()
+        end_date = parse_date_param(request.args['end']) if request.args.get('end') else today
+        start_date = parse_date_param(request.args['start']) if request.args.get('start') else end_date - timedelta(days=HISTORY_DAYS)
+        period = request.args.get('period', 'daily')
+        points = int(request.args['points']) if request.args.get('points') else None
+    except ValueError as e:
+        return jsonify({"error": f"参数错误: {str(e)}"}), 400
+    adjust = request.args.get('adjust', 'qfq')
+    if adjust not in ADJUST_MODES:
+        return jsonify({"error": f"adjust 只能是 {', '.join(ADJUST_MODES)}"}), 400
+    if start_date > end_date:
+        return jsonify({"error": "开始日期不能晚于结束日期"}), 400
+    if period not in KLINE_PERIODS:
+        return jsonify({"error": f"period 只能是 {', '.join(KLINE_PERIODS)}"}), 400
+    if points is not None and not 2 <= points <= MAX_HISTORY_POINTS:
+        return jsonify({"error": f"points 必须在 2 到 {MAX_HISTORY_POINTS} 之间"}), 400
+
+    try:
+        with stage('store'):
+            bars = kline_store.get_daily(stock_code, adjust, start_date, today)
+            bars = slice_bars(bars, start_date, end_date)
+
+        if len(bars) == 0:
             return jsonify({"error": "未找到该股票的历史数据"}), 404
-        
-        # Helper to convert to float or None
-        def to_float_or_none(val):
-            try: return float(val) if pd.notna(val) else None
-            except ValueError: return None
-        # Helper to convert to int or None
-        def to_int_or_none(val):
-            try: return int(val) if pd.notna(val) else None
-            except ValueError: return None
-
-        history_data = []
-        for index, row in stock_hist_df.iterrows():
-            history_data.append({
-                "date": row['日期'], 
-                "open": to_float_or_none(row['开盘']),
-                "close": to_float_or_none(row['收盘']),
-                "low": to_float_or_none(row['最低']),
-                "high": to_float_or_none(row['最高']),
-                "volume": to_int_or_none(row['成交量']), 
-            })
-        return jsonify(history_data)
+
+        etag = bars_etag(stock_code, adjust, bars, request.args)
+        last_modified = kline_store.modified(stock_code)
+        cache_control = daily_cache_control()
+        cached = cached_response(etag, last_modified, cache_control)
+        if cached is not None:
+            return cached
+
+        with stage('window'):
+            if points is not None:
+                bars, period = downsample_bars(bars, points, period)
+            else:
+                bars = rollup_bars(bars, period)
+
+        with stage('convert'):
+            payload = bars_to_columns(bars) if request.args.get('format') == 'columns' else bars_to_records(bars)
+        response = json_response(payload)
+        response.headers['X-Kline-Period'] = period # 实际使用的K线周期，降采样后可能比请求的更粗
+        return mark_cacheable(response, etag, last_modified, cache_control)
+    except UpstreamUnavailable as e:
+        return jsonify({"error": str(e)}), 503
+    except UpstreamTimeout as e:
+        print(f"Upstream timeout for {request.path}: {e}")
+        return jsonify({"error": f"数据源响应超时: {str(e)}"}), 504
     except Exception as e:
         print(f"Error fetching historical data for {stock_code}: {e}")
         return jsonify({"error": f"获取历史数据失败: {str(e)}"}), 500
 
+@app.route('/api/indicators', methods=['GET'])
+def indicators_stock_data():
+    stock_code = request.args.get('code', '').strip()
+    if not is_stock_code(stock_code):
+        return jsonify({"error": "无效的股票代码格式"}), 400
+
+    try:
+        # e.g. indicators=ma:5,ma:20,macd,rsi:14,boll:20:2,kdj:9:3:3
+        specs = [parse_indicator_spec(spec) for spec in request.args.get('indicators', 'ma:5,ma:20,macd').split(',') if spec.strip()]
+        today = market_now().date()
+        end_date = parse_date_param(request.args['end']) if request.args.get('end') else today
+        start_date = parse_date_param(request.args['start']) if request.args.get('start') else end_date - timedelta(days=HISTORY_DAYS)
+    except ValueError as e:
+        return jsonify({"error": f"参数错误: {str(e)}"}), 400
+    adjust = request.args.get('adjust', 'qfq')
+    if adjust not in ADJUST_MODES:
+        return jsonify({"error": f"adjust 只能是 {', '.join(ADJUST_MODES)}"}), 400
+    if not specs or len(specs) > MAX_INDICATORS_PER_REQUEST:
+        return jsonify({"error": f"请指定 1 到 {MAX_INDICATORS_PER_REQUEST} 个指标"}), 400
+
+    try:
+        with stage('store'):
+            kline_store.get_raw(stock_code, start_date, today)
+            # Indicators run over the whole stored series so averages are warmed up at `start`
+            bars = kline_store.load(stock_code, adjust)
+        if bars is None or len(bars) == 0:
+            return jsonify({"error": "未找到该股票的历史数据"}), 404
+        etag = bars_etag(stock_code, adjust, bars, request.args)
+        last_modified = kline_store.modified(stock_code)
+        cache_control = daily_cache_control()
+        cached = cached_response(etag, last_modified, cache_control)
+        if cached is not None:
+            return cached
+        lo, hi = window_bounds(bars['date'], start_date, end_date)
+        indicators = {}
+        with stage('indicators'):
+            for indicator, params in specs:
+                outputs = indicator_cache.get(stock_code, adjust, indicator, params, bars)
+                label = ':'.join([indicator.name] + [f"{param:g}" for param in params])
+                indicators[label] = {name: convert_column(values[lo:hi], 'float') for name, values in outputs.items()}
+        response = json_response({
+            "date": np.datetime_as_string(bars['date'][lo:hi], unit='D').tolist(),
+            "indicators": indicators,
+        })
+        return mark_cacheable(response, etag, last_modified, cache_control)
+    except UpstreamUnavailable as e:
+        return jsonify({"error": str(e)}), 503
+    except UpstreamTimeout as e:
+        print(f"Upstream timeout for {request.path}: {e}")
+        return jsonify({"error": f"数据源响应超时: {str(e)}"}), 504
+    except Exception as e:
+        print(f"Error computing indicators for {stock_code}: {e}")
+        return jsonify({"error": f"计算技术指标失败: {str(e)}"}), 500
+
+@app.route('/api/intraday', methods=['GET'])
+def intraday_stock_data():
+    stock_code = request.args.get('code', '').strip()
+    if not is_stock_code(stock_code):
+        return jsonify({"error": "无效的股票代码格式"}), 400
+
+    try:
+        # period=1|5|15 分钟; date 省略时为当前交易日; since=HH:MM 只返回该时刻及之后的K线（增量轮询）
+        period = int(request.args.get('period', '1'))
+        day = parse_date_param(request.args['date']) if request.args.get('date') else None
+        since = datetime.strptime(request.args['since'], '%H:%M').time() if request.args.get('since') else None
+    except ValueError as e:
+        return jsonify({"error": f"参数错误: {str(e)}"}), 400
+    if period not in INTRADAY_PERIODS:
+        return jsonify({"error": f"period 只能是 {', '.join(map(str, INTRADAY_PERIODS))}"}), 400
+
+    with stage('intraday'):
+        today = market_now().date()
+        if SHARED_SNAPSHOT and day in (None, today):
+            return jsonify({"error": "多进程模式下不提供当日分时K线，请以单进程方式运行"}), 503
+        day = day or intraday_book.session or today
+        bars = intraday_book.window(stock_code) if day == intraday_book.session else None
+        if bars is None and day in (today, intraday_book.session):
+            # Start collecting this code's bars from the next snapshot on
+            if not intraday_book.subscribe([stock_code]):
+                return jsonify({"error": f"分时订阅已达上限 ({INTRADAY_MAX_SYMBOLS} 只)"}), 400
+        if bars is None:
+            bars = intraday_book.load(stock_code, day)
+        if bars is None:
+            if day not in (today, intraday_book.session):
+                return jsonify({"error": "未找到该股票当日的分时数据"}), 404
+            bars = np.empty(0, dtype=MINUTE_DTYPE)
+        bars = rollup_minutes(bars, period)
+        if since is not None:
+            bars = bars[np.searchsorted(bars['date'], np.datetime64(datetime.combine(day, since), 'm')):]
+
+    with stage('convert'):
+        payload = bars_to_columns(bars) if request.args.get('format') == 'columns' else bars_to_records(bars)
+    response = json_response(payload)
+    response.headers['X-Intraday-Date'] = str(day)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# --- Serving ---
+# threaded: Flask's built-in server, one thread per connection.
+# asgi: the same app behind a small ASGI bridge under uvicorn. Connections, including idle
+# keep-alive ones, are held by the event loop; only a request that is actually being handled
+# occupies one of ASGI_WORKERS threads, and upstream waits inside it are bounded by
+# call_upstream. Also usable directly: uvicorn stock_dashboard:asgi_app
+ASGI_WORKERS = int(os.environ.get('STOCKAI_ASGI_WORKERS', '32'))
+
+def start_background_services():
+    if SHARED_SNAPSHOT:
+        # A fetcher process owns the upstream calls; this process only follows it
+        start_shared_follower()
+        get_stock_list_cached()
+        return
+    # Load the saved stock list (milliseconds) and refresh it in the background
+    get_stock_list_cached()
+    if os.environ.get('STOCKAI_BACKGROUND_REFRESH', '1') != '0':
+        start_snapshot_refresher()
+
+
+class DashboardASGI:
+    def __init__(self, wsgi_app, workers=ASGI_WORKERS):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='asgi-worker')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                start_background_services()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        if scope['path'] == '/api/stream' and scope['method'] == 'GET':
+            await self.stream(scope, receive, send)
+            return
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        loop = asyncio.get_running_loop()
+        status, headers, chunks = await loop.run_in_executor(self.executor, self.run_wsgi, self.wsgi_environ(scope, body))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b''.join(chunks)})
+
+    async def stream(self, scope, receive, send):
+        # Served on the event loop itself, so an open stream costs no worker thread
+        args = parse_qs(scope['query_string'].decode('latin-1'))
+        codes, error, status = resolve_request_codes(args.get('codes', [''])[0].split(','), args.get('watchlist', [''])[0])
+        if error:
+            await send({'type': 'http.response.start', 'status': status,
+                        'headers': [(b'content-type', b'application/json')]})
+            await send({'type': 'http.response.body', 'body': dumps_json({"error": error})})
+            return
+        subscription = LoopSubscription(codes, asyncio.get_running_loop())
+        disconnected = asyncio.ensure_future(self.wait_disconnect(receive))
+        quote_broadcaster.add(subscription)
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ]})
+            while not subscription.closed and not disconnected.done():
+                event = await subscription.next_event(STREAM_HEARTBEAT)
+                body = b": keep-alive\n\n" if event is None else format_sse(*event)
+                await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+        finally:
+            quote_broadcaster.remove(subscription)
+            disconnected.cancel()
+
+    @staticmethod
+    async def wait_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    def run_wsgi(self, environ):
+        response = {}
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+        result = self.wsgi_app(environ, start_response)
+        try:
+            chunks = list(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response['status'], response['headers'], chunks
+
+    @staticmethod
+    def wsgi_environ(scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope.get('headers', []):
+            name, value = name.decode('latin-1'), value.decode('latin-1')
+            if name == 'content-type':
+                environ['CONTENT_TYPE'] = value
+            elif name == 'content-length':
+                environ['CONTENT_LENGTH'] = value
+            else:
+                key = 'HTTP_' + name.upper().replace('-', '_')
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+
+asgi_app = DashboardASGI(app)
+
+# --- History prefetch ---
+# python stock_dashboard.py prefetch [--codes ...] [--watchlist 自选]
+# Downloads daily bars (raw prices and adjustment factors, so every adjust mode is covered) for
+# the whole A-share list (or a subset) into the K-line store ahead of time, e.g. from cron
+# after the close, so chart views read the store instead of waiting for a multi-second
+# stock_zh_a_hist download. Fetches go through the upstream client
+# like any request, so the worker threads share its rate limit, retries and circuit breaker.
+# Progress is saved to data/prefetch.json; running again on the same day resumes.
+PREFETCH_WORKERS = int(os.environ.get('STOCKAI_PREFETCH_WORKERS', '4'))
+PREFETCH_STATE_FILE = os.path.join(DATA_DIR, 'prefetch.json')
+PREFETCH_REPORT_INTERVAL = 10 # 秒
+PREFETCH_ATTEMPTS = 3 # per symbol, while the circuit is open or the rate limit is exhausted
+
+def load_prefetch_state(run):
+    try:
+        with open(PREFETCH_STATE_FILE, encoding='utf-8') as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return set()
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable prefetch progress {PREFETCH_STATE_FILE}: {e}")
+        return set()
+    return set(state['done']) if state.get('run') == run else set()
+
+def save_prefetch_state(run, done):
+    os.makedirs(DATA_DIR, exist_ok=True)
+    tmp_path = f"{PREFETCH_STATE_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"run": run, "done": sorted(done)}, f)
+    os.replace(tmp_path, PREFETCH_STATE_FILE)
+
+def prefetch_symbol(code, start, end):
+    # Waits out an open circuit instead of failing every remaining symbol in a few milliseconds
+    for attempt in range(1, PREFETCH_ATTEMPTS + 1):
+        try:
+            return len(kline_store.get_raw(code, start, end, fallback=False)[0])
+        except UpstreamUnavailable:
+            if attempt == PREFETCH_ATTEMPTS:
+                raise
+            time.sleep(max(1, upstream.breaker('stock_zh_a_hist').retry_in()))
+
+def run_prefetch(codes, workers=PREFETCH_WORKERS, resume=True):
+    end = market_now().date()
+    start = end - timedelta(days=HISTORY_DAYS)
+    run = {"end": str(end)}
+    done = load_prefetch_state(run) if resume else set()
+    pending = [code for code in dict.fromkeys(codes) if code not in done]
+    print(f"Prefetching daily bars of {len(pending)} symbols "
+          f"({len(codes) - len(pending)} already done today) with {workers} workers")
+    stats_before = dict(kline_store.stats)
+    failed = {}
+    finished = bars = 0
+    started = last_report = time.monotonic()
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+    futures = {executor.submit(prefetch_symbol, code, start, end): code for code in pending}
+    try:
+        for future in as_completed(futures):
+            code = futures[future]
+            try:
+                bars += future.result()
+                done.add(code)
+            except Exception as e:
+                failed[code] = str(e)
+            finished += 1
+            now = time.monotonic()
+            if now - last_report >= PREFETCH_REPORT_INTERVAL or finished == len(pending):
+                rate = finished / max(now - started, 1e-9)
+                print(f"[{finished}/{len(pending)}] {finished / len(pending):.0%}, {rate:.1f} symbols/s, "
+                      f"ETA {(len(pending) - finished) / rate:.0f}s, {len(failed)} failed")
+                save_prefetch_state(run, done)
+                last_report = now
+    except KeyboardInterrupt:
+        executor.shutdown(wait=False, cancel_futures=True)
+        save_prefetch_state(run, done)
+        print(f"Interrupted after {finished} symbols; run prefetch again to resume.")
+        return 130
+    executor.shutdown()
+    save_prefetch_state(run, done)
+
+    elapsed = time.monotonic() - started
+    fetched = {outcome: kline_store.stats[outcome] - stats_before[outcome] for outcome in ('hit', 'update', 'rewrite')}
+    print(f"Prefetched {finished - len(failed)} symbols ({bars} bars) in {elapsed:.0f}s: "
+          f"{finished / max(elapsed, 1e-9):.1f} symbols/s; "
+          f"{fetched['rewrite']} full downloads, {fetched['update']} updates, {fetched['hit']} already current")
+    for code, error in list(failed.items())[:10]:
+        print(f"  {code}: {error}")
+    if failed:
+        print(f"{len(failed)} symbols failed; run prefetch again to retry them.")
+    return 1 if failed else 0
+
 if __name__ == '__main__':
-    # Pre-fetch stock list on startup to make name search faster
-    # This might take a few seconds on first run
-    get_stock_list_cached() 
-    print(f"股票数据看板已启动。请在浏览器中打开 http://127.0.0.1:5001")
-    app.run(debug=False, host='0.0.0.0', port=5001)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='股票数据看板 (A股)')
+    parser.add_argument('command', nargs='?', choices=('serve', 'prefetch'), default='serve',
+                        help='serve: 启动看板（默认）；prefetch: 预先下载日K线到本地存储')
+    parser.add_argument('--server', choices=('threaded', 'asgi', 'fetcher'), default=os.environ.get('STOCKAI_SERVER', 'threaded'),
+                        help='threaded: Flask 内置服务器；asgi: uvicorn (需安装 uvicorn)；fetcher: 只获取行情并写入共享内存')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('STOCKAI_WORKERS', '1')),
+                        help='asgi 模式下的工作进程数；大于 1 时由一个 fetcher 进程统一获取行情并通过共享内存分发')
+    parser.add_argument('--codes', nargs='+', default=[], help='prefetch: 只预取这些股票代码')
+    parser.add_argument('--watchlist', action='append', default=[], help='prefetch: 只预取该自选股列表，可重复')
+    parser.add_argument('--threads', type=int, default=PREFETCH_WORKERS, help='prefetch: 并发线程数，共用上游限流')
+    parser.add_argument('--restart', action='store_true', help='prefetch: 忽略今天已保存的进度，从头开始')
+    args = parser.parse_args()
+
+    if args.command == 'prefetch':
+        codes = list(args.codes)
+        lists = load_watchlists() if args.watchlist else {}
+        for name in args.watchlist:
+            if name not in lists:
+                parser.error(f"未找到自选股列表 '{name}'")
+            codes += lists[name]
+        if not codes and not args.watchlist:
+            stocks = get_stock_list_cached()
+            if stocks.empty: # cold start without a saved list
+                stocks = refresh_stock_list()
+            codes = stocks['代码'].tolist()
+        invalid = [code for code in codes if not is_stock_code(code)]
+        if invalid:
+            parser.error(f"无效的股票代码格式: {', '.join(invalid[:10])}")
+        sys.exit(run_prefetch(codes, workers=max(1, args.threads), resume=not args.restart))
+    if args.server == 'fetcher':
+        run_shared_publisher(SHARED_SNAPSHOT or 'stockai')
+        sys.exit(0)
+    if args.workers > 1 and args.server != 'asgi':
+        parser.error("--workers 仅支持 --server asgi")
+
+    print(f"股票数据看板已启动。请在浏览器中打开 http://127.0.0.1:{args.port}")
+    if args.server == 'asgi':
+        try:
+            import uvicorn
+        except ImportError:
+            parser.error("ASGI 模式需要安装 uvicorn: pip install uvicorn")
+        if args.workers > 1:
+            # Workers are fresh interpreters that import this module and read the prefix from
+            # the environment; the fetcher is started first so its segments exist when they do
+            prefix = os.environ.setdefault('STOCKAI_SHARED_SNAPSHOT', f"stockai-{os.getpid()}")
+            fetcher = multiprocessing.Process(target=run_shared_publisher, args=(prefix,), name='stockai-fetcher', daemon=True)
+            fetcher.start()
+            try:
+                uvicorn.run('stock_dashboard:asgi_app', app_dir=os.path.dirname(os.path.abspath(__file__)),
+                            workers=args.workers, host=args.host, port=args.port, log_level='warning')
+            finally:
+                fetcher.terminate()
+                fetcher.join(5)
+        else:
+            uvicorn.run(asgi_app, host=args.host, port=args.port, log_level='warning') # lifespan starts the services
+    else:
+        start_background_services()
+        app.run(debug=False, host=args.host, port=args.port, threaded=True)
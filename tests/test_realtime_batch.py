@@ -0,0 +1,41 @@
+# /api/realtime/batch parameter handling, served from a fake-backend snapshot
+import os
+import sys
+
+os.environ.setdefault('STOCKAI_UPSTREAM_BACKEND', 'fake')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pytest
+
+import stock_dashboard as sd
+
+
+@pytest.fixture
+def client(monkeypatch):
+    snapshot = sd.SpotSnapshot(sd.FakeUpstreamBackend(symbols=20).stock_zh_a_spot_em())
+    monkeypatch.setattr(sd.spot_cache, 'get', lambda *args, **kwargs: snapshot)
+    return sd.app.test_client()
+
+
+def test_json_body(client):
+    response = client.post('/api/realtime/batch', json={"codes": ["600001", "000001"], "fields": ["price"]})
+    assert response.status_code == 200
+    assert [quote['code'] for quote in response.get_json()['quotes']] == ['600001', '000001']
+
+
+def test_malformed_json_body_is_rejected(client):
+    for url in ('/api/realtime/batch?codes=600001', '/api/realtime/batch'):
+        response = client.post(url, data='{bad', content_type='application/json')
+        assert response.status_code == 400
+        assert response.get_json()['error'] == "请求体不是合法的 JSON"
+
+
+@pytest.mark.parametrize('body', [[1, 2], {"codes": 600001}, {"watchlist": ["a"]}])
+def test_wrong_body_types_are_rejected(client, body):
+    assert client.post('/api/realtime/batch', json=body).status_code == 400
+
+
+def test_empty_post_falls_back_to_the_query_string(client):
+    response = client.post('/api/realtime/batch?codes=600001')
+    assert response.status_code == 200
+    assert response.get_json()['quotes'][0]['code'] == '600001'
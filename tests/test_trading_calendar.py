@@ -0,0 +1,57 @@
+# Holidays on weekdays: no trading session, no intraday bars from the frozen spot table
+import json
+import os
+import sys
+from datetime import date, datetime
+
+os.environ.setdefault('STOCKAI_UPSTREAM_BACKEND', 'fake')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pandas as pd
+import pytest
+
+import stock_dashboard as sd
+
+NATIONAL_DAY = date(2026, 10, 1)
+
+
+@pytest.fixture
+def calendar(tmp_path, monkeypatch):
+    days = [day for day in pd.bdate_range('2026-01-01', '2026-12-31').date if not date(2026, 10, 1) <= day <= date(2026, 10, 8)]
+    path = tmp_path / 'trade_dates.json'
+    path.write_text(json.dumps({"dates": [str(day) for day in days]}))
+    calendar = sd.TradingCalendar(str(path))
+    monkeypatch.setattr(sd, 'trading_calendar', calendar)
+    return calendar
+
+
+def test_holiday_is_not_a_session(calendar):
+    now = datetime(2026, 10, 1, 10, 0, tzinfo=sd.MARKET_TZ)
+    assert not calendar.is_trading_day(NATIONAL_DAY)
+    assert calendar.is_trading_day(date(2026, 10, 9))
+    assert not sd.in_trading_session(now)
+    assert sd.minute_label(now) is None
+    assert sd.seconds_until_next_session(now) == (datetime(2026, 10, 9, 9, 15, tzinfo=sd.MARKET_TZ) - now).total_seconds()
+
+
+def test_weekdays_without_a_calendar(tmp_path, monkeypatch):
+    monkeypatch.setattr(sd, 'trading_calendar', sd.TradingCalendar(str(tmp_path / 'missing.json')))
+    assert sd.in_trading_session(datetime(2026, 10, 1, 10, 0, tzinfo=sd.MARKET_TZ))
+
+
+def test_frozen_snapshots_start_no_intraday_session(tmp_path, monkeypatch):
+    # Calendar unavailable: the weekday fallback lets the snapshots through, the frozen volumes don't
+    monkeypatch.setattr(sd, 'trading_calendar', sd.TradingCalendar(str(tmp_path / 'missing.json')))
+    monkeypatch.setattr(sd, 'load_watchlists', lambda: {})
+    book = sd.IntradayBook(str(tmp_path / 'intraday'), 256)
+    book.subscribe(['600001'])
+    frozen = sd.FakeUpstreamBackend(symbols=20).stock_zh_a_spot_em()
+    opened = datetime(2026, 10, 1, 9, 31, tzinfo=sd.MARKET_TZ).timestamp()
+    previous = None
+    for minutes in (0, 10, 30):
+        snapshot = sd.SpotSnapshot(frozen, fetched_at=opened + 60 * minutes, previous=previous)
+        book.on_snapshot(previous, snapshot)
+        previous = snapshot
+    assert book.session is None
+    assert book.window('600001').size == 0
+    assert not os.path.exists(tmp_path / 'intraday')
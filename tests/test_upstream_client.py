@@ -0,0 +1,79 @@
+# Offline checks of the upstream client's retry and circuit-breaker paths, driven through the
+# fake backend:  python -m pytest tests
+import os
+import sys
+
+os.environ.setdefault('STOCKAI_UPSTREAM_BACKEND', 'fake')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pytest
+
+import stock_dashboard as sd
+
+
+class FlakyBackend(sd.FakeUpstreamBackend):
+    # Fails the first `failures` calls, then answers like the fake backend
+    def __init__(self, failures):
+        super().__init__(symbols=20)
+        self.failures = failures
+        self.calls = 0
+
+    def stock_fuzzy_search(self, keyword):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise ConnectionError("flaky upstream")
+        return super().stock_fuzzy_search(keyword)
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(sd, 'UPSTREAM_RETRY_BASE', 0)
+    monkeypatch.setattr(sd, 'UPSTREAM_RETRIES', 2)
+
+
+def make_client(failures):
+    client = sd.UpstreamClient(FlakyBackend(failures))
+    client.bucket = sd.TokenBucket(0, 1) # unlimited, and independent of data/upstream.bucket
+    client.breakers['stock_fuzzy_search'] = sd.CircuitBreaker(threshold=2)
+    return client
+
+def retries(endpoint):
+    return sd.UPSTREAM_RETRY_COUNT._values.get((endpoint,), 0)
+
+
+def test_retries_then_succeeds():
+    client = make_client(failures=2)
+    before = retries('stock_fuzzy_search')
+    df = client.call('stock_fuzzy_search', keyword='0001')
+    assert len(df) > 0
+    assert client.backend.calls == 3
+    assert retries('stock_fuzzy_search') - before == 2
+    assert client.breaker('stock_fuzzy_search').state == 'closed'
+
+
+def test_exhausted_retries_open_the_breaker():
+    client = make_client(failures=100)
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            client.call('stock_fuzzy_search', keyword='0001')
+    assert client.backend.calls == 6 # 1 attempt + 2 retries, twice
+    assert client.breaker('stock_fuzzy_search').state == 'open'
+    with pytest.raises(sd.UpstreamUnavailable):
+        client.call('stock_fuzzy_search', keyword='0001')
+    assert client.backend.calls == 6
+
+
+def test_failed_half_open_probe_reopens():
+    client = make_client(failures=100)
+    breaker = client.breaker('stock_fuzzy_search')
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            client.call('stock_fuzzy_search', keyword='0001')
+    breaker.opened_at -= breaker.reset_timeout # let the next call probe
+    with pytest.raises(ConnectionError):
+        client.call('stock_fuzzy_search', keyword='0001')
+    assert not breaker.probing
+    client.backend.failures = 0
+    breaker.opened_at -= breaker.reset_timeout
+    assert len(client.call('stock_fuzzy_search', keyword='0001')) > 0
+    assert breaker.state == 'closed'